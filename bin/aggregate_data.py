@@ -1,12 +1,26 @@
 #!/usr/bin/env python3
 
 import argparse
+import json
 import logging
 from pathlib import Path
 
+import numpy as np
 import polars as pl
 
-from common import parse_vcf_data, get_position_in_format
+from common import (
+    ALLELE_COUNTS_METADATA_KEY,
+    add_region_arguments,
+    build_quantile_sketches,
+    get_allele_counts,
+    get_regions,
+    get_samples,
+    get_sketch_quantiles,
+    join_pvalues,
+    parse_typed_vcf_data,
+    partition_by_contig,
+    scan_pvalues,
+)
 
 pl.Config.set_streaming_chunk_size(int(1e6))
 
@@ -35,7 +49,7 @@ def parse_args():
         type=Path,
         dest="vcf_file",
         required=True,
-        help="Path to VCF file",
+        help="Path to VCF file (or VCF store)",
     )
     parser.add_argument(
         "--pvalues",
@@ -62,13 +76,40 @@ def parse_args():
         required=True,
         help="Window size",
     )
+    parser.add_argument(
+        "--window-step",
+        dest="window_step",
+        default=None,
+        help="Step between the starts of consecutive windows (window size by default): "
+        "windows overlap when it is smaller than the window size "
+        "(with --quantile-sketch-error, the window size must be a multiple of it)",
+    )
+    parser.add_argument(
+        "--quantiles",
+        type=float,
+        nargs="+",
+        default=[QUANTILE],
+        help="Quantiles of p-values computed for each window: the first one is written "
+        "in the pvalue column, the others in pvalue_<quantile> columns",
+    )
+    parser.add_argument(
+        "--quantile-sketch-error",
+        dest="quantile_sketch_error",
+        type=float,
+        default=None,
+        help="Estimate window quantiles with sketches of this relative error (e.g. 0.01) "
+        "instead of computing them exactly, so that memory does not grow with the number of variants per window",
+    )
+    add_region_arguments(parser)
     return parser.parse_args()
 
 
-def parse_pvalues(cmh_pvalues_file: Path) -> pl.LazyFrame:
-    return pl.scan_csv(
-        cmh_pvalues_file, has_header=False, new_columns=["pvalue"], null_values=["NA"]
-    )
+def parse_window_length(value: str) -> int:
+    # lengths may be given in scientific notation (e.g. 2E4)
+    try:
+        return int(float(value))
+    except ValueError:
+        raise TypeError(f"Could not cast {value} to integer.")
 
 
 def add_windows(lf: pl.LazyFrame, window_size: int) -> pl.LazyFrame:
@@ -79,26 +120,6 @@ def add_windows(lf: pl.LazyFrame, window_size: int) -> pl.LazyFrame:
     )
 
 
-def format_count_per_sample(phenotype_to_samples: dict):
-    expr = ( pl.lit("Counts (REF / ALT / ...):<br>") )
-    for phenotype, samples in phenotype_to_samples.items():
-        expr += (pl.lit(f"  Phenotype: {phenotype}:<br>"))
-        for sample in samples:
-            ad_col = f"{sample}_AD"
-            expr += (
-                pl.lit(f"    {sample}: ")
-                + pl.when(
-                    pl.col(ad_col).is_not_null()
-                ).then(
-                    pl.col(ad_col).list.join(" / ")
-                ).otherwise(
-                    pl.lit("")
-                )
-                + pl.lit("<br>")
-            )
-    yield expr.alias("allele_counts")
-
-
 def get_window_allele_count_expr(populations: list[str]):
     for pop in populations:
         yield (
@@ -122,14 +143,193 @@ def get_window_allele_count_expr(populations: list[str]):
         ).alias(pop)
 
 
-def add_total_depth(lf: pl.LazyFrame) -> pl.Series:
-    return lf.with_columns(
-        pl.col("INFO").str.extract(r"DP=(\d+)").cast(pl.Int64).alias("total_depth")
+def get_quantile_columns(quantiles: list[float]) -> dict[str, float]:
+    # the first quantile is the one displayed in reports
+    return {
+        "pvalue" if i == 0 else f"pvalue_{quantile:g}": quantile
+        for i, quantile in enumerate(quantiles)
+    }
+
+
+def aggregate_windows(
+    lf: pl.LazyFrame,
+    window_size: int,
+    window_step: int,
+    quantile_columns: dict[str, float],
+    sketch_error: float | None,
+) -> pl.LazyFrame:
+    """
+    Aggregates variants over the windows [k * window_step, k * window_step + window_size)
+    of each contig holding at least one variant, windows being labelled by their centre.
+    """
+    if sketch_error is not None:
+        return aggregate_windows_with_sketches(
+            lf, window_size, window_step, quantile_columns, sketch_error
+        )
+    if window_step != window_size:
+        # windows of a contig need all its variants: the sweep runs once on the whole frame
+        return lf.select(
+            "CHROM",
+            pl.col("POS").cast(pl.Int64),
+            pl.col("pvalue").cast(pl.Float64),
+            pl.col("QUAL").cast(pl.Float64),
+            pl.col("total_depth").cast(pl.Float64),
+        ).map_batches(
+            lambda df: sweep_windows(df, window_size, window_step, quantile_columns),
+            schema=get_window_schema(quantile_columns),
+            streamable=False,
+            projection_pushdown=False,
+            predicate_pushdown=False,
+        )
+    # each variant belongs to a single window
+    return (
+        add_windows(lf, window_size)
+        .group_by(["CHROM", "window"])
+        .agg(
+            *[
+                pl.col("pvalue").quantile(quantile).alias(name)
+                for name, quantile in quantile_columns.items()
+            ],
+            pl.col("QUAL").mean().alias("quality"),
+            pl.col("total_depth").mean(),
+        )
+    )
+
+
+def get_window_schema(quantile_columns: dict[str, float]) -> pl.Schema:
+    return pl.Schema(
+        {
+            "CHROM": pl.String,
+            "window": pl.Int64,
+            **{name: pl.Float64 for name in quantile_columns},
+            "quality": pl.Float64,
+            "total_depth": pl.Float64,
+        }
+    )
+
+
+def sweep_windows(
+    variants_df: pl.DataFrame,
+    window_size: int,
+    window_step: int,
+    quantile_columns: dict[str, float],
+) -> pl.DataFrame:
+    """
+    Exact aggregation of overlapping windows in a single sweep over the sorted positions
+    of each contig: the first and last rows of all windows are found with search_sorted,
+    means are differences of cumulative sums and quantiles are selected (np.partition)
+    from the slice of p-values of each window, so that no row is copied into several windows.
+    Quantiles are the values of rank round(q * (n - 1)), as pl.Expr.quantile does.
+    """
+    quantiles = np.array(list(quantile_columns.values()))
+    window_dfs = []
+    for contig, contig_df in partition_by_contig(variants_df).items():
+        if not contig_df["POS"].is_sorted():
+            contig_df = contig_df.sort("POS")
+        positions = contig_df["POS"].to_numpy()
+        window_starts = np.arange(0, positions[-1] + 1, window_step)
+        window_ends = window_starts + window_size
+        first_rows = np.searchsorted(positions, window_starts)
+        last_rows = np.searchsorted(positions, window_ends)
+        columns = {
+            "CHROM": pl.repeat(contig, len(window_starts), eager=True),
+            "window": window_starts + int(window_size / 2),
+        }
+
+        for name, col in {"quality": "QUAL", "total_depth": "total_depth"}.items():
+            values = contig_df[col]
+            sums = np.concatenate([[0], values.fill_null(0).cum_sum().to_numpy()])
+            counts = np.concatenate([[0], values.is_not_null().cum_sum().to_numpy()])
+            nb_values = counts[last_rows] - counts[first_rows]
+            columns[name] = pl.Series(
+                (sums[last_rows] - sums[first_rows]) / np.maximum(nb_values, 1)
+            ).set(pl.Series(nb_values == 0), None)
+
+        pvalues_df = contig_df.select("POS", "pvalue").drop_nulls("pvalue")
+        pvalue_positions = pvalues_df["POS"].to_numpy()
+        pvalues = pvalues_df["pvalue"].to_numpy()
+        first_pvalues = np.searchsorted(pvalue_positions, window_starts)
+        last_pvalues = np.searchsorted(pvalue_positions, window_ends)
+        window_quantiles = np.full((len(window_starts), len(quantiles)), np.nan)
+        for i in np.flatnonzero(last_pvalues > first_pvalues):
+            window_pvalues = pvalues[first_pvalues[i]:last_pvalues[i]]
+            ranks = np.floor((len(window_pvalues) - 1) * quantiles + 0.5).astype(np.int64)
+            window_quantiles[i] = np.partition(window_pvalues, ranks)[ranks]
+        for j, name in enumerate(quantile_columns):
+            columns[name] = pl.Series(window_quantiles[:, j]).set(
+                pl.Series(last_pvalues == first_pvalues), None
+            )
+
+        # windows without any variant are left out
+        window_dfs.append(pl.DataFrame(columns).filter(pl.Series(last_rows > first_rows)))
+    schema = get_window_schema(quantile_columns)
+    return pl.concat(
+        [window_df.select(schema.names()).cast(schema) for window_df in window_dfs]
+        or [pl.DataFrame(schema=schema)]
     )
 
 
-def get_length(lf: pl.LazyFrame) -> int:
-    return lf.select(pl.len()).collect().item(0, 0)
+def aggregate_windows_with_sketches(
+    lf: pl.LazyFrame,
+    window_size: int,
+    window_step: int,
+    quantile_columns: dict[str, float],
+    sketch_error: float,
+) -> pl.LazyFrame:
+    """
+    Each window is made of window_size / window_step consecutive blocks of window_step bases:
+    sums and quantile sketches are computed once per block, then merged into each window holding it.
+    """
+    nb_blocks_per_window = window_size // window_step
+    by = ["CHROM", "window"]
+    blocks_lf = lf.with_columns((pl.col("POS") // window_step).alias("block"))
+
+    def to_windows(block_stats_lf: pl.LazyFrame) -> pl.LazyFrame:
+        return (
+            block_stats_lf.with_columns(
+                pl.int_ranges(
+                    pl.col("block") - nb_blocks_per_window + 1, pl.col("block") + 1
+                ).alias("window")
+            )
+            .explode("window")
+            .filter(pl.col("window") >= 0)
+            .drop("block")
+        )
+
+    means = {"quality": "QUAL", "total_depth": "total_depth"}
+    sums_lf = to_windows(
+        blocks_lf.group_by(["CHROM", "block"]).agg(
+            *[pl.col(col).sum().alias(f"{name}_sum") for name, col in means.items()],
+            *[pl.col(col).count().alias(f"{name}_count") for name, col in means.items()],
+        )
+    ).group_by(by).sum()
+    sketches_lf = to_windows(
+        build_quantile_sketches(blocks_lf, ["CHROM", "block"], "pvalue", sketch_error)
+    )
+    # windows without any p-value have no sketch
+    return (
+        sums_lf.select(
+            *by,
+            *[
+                pl.when(pl.col(f"{name}_count") > 0)
+                .then(pl.col(f"{name}_sum") / pl.col(f"{name}_count"))
+                .alias(name)
+                for name in means
+            ],
+        )
+        .join(
+            get_sketch_quantiles(sketches_lf, by, quantile_columns, sketch_error),
+            on=by,
+            how="left",
+        )
+        .with_columns(
+            (pl.col("window") * window_step + int(window_size / 2)).alias("window")
+        )
+    )
+
+
+def add_total_depth(lf: pl.LazyFrame) -> pl.LazyFrame:
+    return lf.with_columns(pl.col("INFO_DP").alias("total_depth"))
 
 
 #####################################################
@@ -141,63 +341,55 @@ def get_length(lf: pl.LazyFrame) -> int:
 
 def main():
     args = parse_args()
+    regions = get_regions(args)
 
-    try:
-        window_size = int(float(args.window_size))
-        logger.info(f"Window size: {window_size}")
-    except ValueError:
-        raise TypeError(f"Could not cast {args.window_size} to integer.")
+    window_size = parse_window_length(args.window_size)
+    window_step = (
+        window_size if args.window_step is None else parse_window_length(args.window_step)
+    )
+    if window_step <= 0:
+        raise ValueError(f"Window step must be positive: {window_step}")
+    # sketches are merged from blocks of window_step bases
+    if args.quantile_sketch_error is not None and window_size % window_step != 0:
+        raise ValueError(
+            f"Window size ({window_size}) must be a multiple of window step ({window_step}) "
+            "when using quantile sketches."
+        )
+    logger.info(f"Window size: {window_size}, window step: {window_step}")
 
     logger.info("Parsing VCF file")
-    vcf_lf = parse_vcf_data(args.vcf_file)
+    samples = get_samples(args.vcf_file)
+    vcf_lf = parse_typed_vcf_data(
+        args.vcf_file, ["AD"], info_fields=["DP"], regions=regions
+    )
 
     logger.info("Parsing p-values")
-    pvalues_lf = parse_pvalues(args.pvalue_file)
+    pvalues_lf = scan_pvalues(args.pvalue_file)
 
-    samples = vcf_lf.collect_schema().names()[9:]
     design_df = pl.read_csv(args.design_file)
     design_df = design_df.filter(pl.col("sample").is_in(samples))
     phenotype_to_samples = {
         d["phenotype"]: d['sample']
-        for d in design_df.group_by("phenotype").agg("sample").to_dicts()
+        for d in design_df.group_by("phenotype", maintain_order=True).agg("sample").to_dicts()
     }
 
-    AD_index = get_position_in_format(vcf_lf, "AD")
-
-    logger.info("Extracting allele depths")
-    for sample in samples:
-        vcf_lf = vcf_lf.with_columns(
-            pl.col(sample)
-            .str.split(":").list[AD_index]
-            .replace(".", None)
-            .str.split(",")
-            .alias(f"{sample}_AD")
-        )
-
-    logger.info("Associating SNPs to windows")
-    vcf_lf = add_windows(vcf_lf, window_size)
-
-    nb_variants = get_length(vcf_lf)
-    nb_pvalues = get_length(pvalues_lf)
-    if nb_variants != nb_pvalues:
-        raise ValueError(
-            f"Number of variants ({nb_variants}) and number of pvalues ({nb_pvalues}) do not match."
-        )
-
-    lf = pl.concat([vcf_lf, pvalues_lf], how="horizontal")
-
+    # p-values are joined while the VCF is read, which is decoded once for both outputs
+    lf = join_pvalues(vcf_lf, pvalues_lf, regions).cache()
 
     logger.info("Computing total depth")
     lf = add_total_depth(lf)
 
+    quantile_columns = get_quantile_columns(args.quantiles)
     logger.info(
-        f"Computing quantile {QUANTILE} of pvalue for each pair of contig & window"
+        f"Computing quantiles {', '.join(map(str, args.quantiles))} "
+        "of pvalue for each pair of contig & window"
     )
+    if args.quantile_sketch_error is not None:
+        logger.info(f"Using quantile sketches with {args.quantile_sketch_error} relative error")
 
-    logger.info("Saving variants")
     variant_lf = (
         lf
-        .with_columns(format_count_per_sample(phenotype_to_samples))
+        .with_columns(get_allele_counts(phenotype_to_samples))
         .rename({"CHROM": "chromosome", "POS": "position", "QUAL": "quality"})
         .select(
             [
@@ -210,15 +402,10 @@ def main():
             ]
         )
     )
-    variant_lf.sink_parquet(f"{args.prefix}.{VARIANTS_OUTFILE_SUFFIX}")
 
-    logger.info("Saving windows")
     window_lf = (
-        lf.group_by(["CHROM", "window"])
-        .agg(
-            pl.col("pvalue").quantile(QUANTILE),
-            pl.col("QUAL").mean().alias("quality"),
-            pl.col("total_depth").mean(),
+        aggregate_windows(
+            lf, window_size, window_step, quantile_columns, args.quantile_sketch_error
         )
         #.with_columns(get_window_allele_count_expr(populations))
         #.with_columns(pl.concat_str(populations, separator="<br>").alias("allele_counts"))
@@ -232,9 +419,23 @@ def main():
                 "total_depth",
                 #"allele_counts",
             ]
+            + list(quantile_columns)[1:]
         )
     )
-    window_lf.sink_parquet(f"{args.prefix}.{GROUPED_VARIANTS_OUTFILE_SUFFIX}")
+
+    logger.info("Saving variants and windows")
+    pl.collect_all(
+        [
+            variant_lf.sink_parquet(
+                f"{args.prefix}.{VARIANTS_OUTFILE_SUFFIX}",
+                metadata={ALLELE_COUNTS_METADATA_KEY: json.dumps(phenotype_to_samples)},
+                lazy=True,
+            ),
+            window_lf.sink_parquet(
+                f"{args.prefix}.{GROUPED_VARIANTS_OUTFILE_SUFFIX}", lazy=True
+            ),
+        ]
+    )
 
 
 
@@ -1,12 +1,22 @@
 #!/usr/bin/env python3
 
 import argparse
+import json
 import logging
 from pathlib import Path
 
 import polars as pl
 
-from common import parse_vcf_data, get_position_in_format
+from common import (
+    ALLELE_COUNTS_METADATA_KEY,
+    add_region_arguments,
+    get_allele_counts,
+    get_regions,
+    get_samples,
+    join_pvalues,
+    parse_typed_vcf_data,
+    scan_pvalues,
+)
 
 pl.Config.set_streaming_chunk_size(int(1e6))
 
@@ -31,32 +41,20 @@ logger.info(f"Polars pool size: {pl.thread_pool_size()}")
 def parse_args():
     parser = argparse.ArgumentParser(description="Aggregate and filter VCF files")
     parser.add_argument(
-        "--vcf1",
+        "--vcf",
         type=Path,
-        dest="vcf_file_1",
+        dest="vcf_files",
+        action="append",
         required=True,
-        help="Path to VCF file",
+        help="Path to VCF file (or VCF store). Can be given several times",
     )
     parser.add_argument(
-        "--vcf2",
+        "--pvalues",
         type=Path,
-        dest="vcf_file_2",
+        dest="pvalue_files",
+        action="append",
         required=True,
-        help="Path to VCF file",
-    )
-    parser.add_argument(
-        "--pvalues1",
-        type=Path,
-        dest="pvalue_file_1",
-        required=True,
-        help="Path to file containing p-values",
-    )
-    parser.add_argument(
-        "--pvalues2",
-        type=Path,
-        dest="pvalue_file_2",
-        required=True,
-        help="Path to file containing p-values",
+        help="Path to file containing p-values, one per VCF file (in the same order)",
     )
     parser.add_argument(
         "--design",
@@ -76,43 +74,18 @@ def parse_args():
         required=True,
         help="Window size",
     )
+    add_region_arguments(parser)
     return parser.parse_args()
 
 
-def parse_pvalues(cmh_pvalues_file: Path) -> pl.DataFrame:
-    return pl.read_csv(
-        cmh_pvalues_file, has_header=False, new_columns=["pvalue"], null_values=["NA"]
-    )
-
-
-def add_windows(df: pl.DataFrame, window_size: int) -> pl.DataFrame:
-    return df.with_columns(
+def add_windows(lf: pl.LazyFrame, window_size: int) -> pl.LazyFrame:
+    return lf.with_columns(
         ((pl.col("POS") // window_size) * window_size + int(window_size / 2)).alias(
             "window"
         )
     )
 
 
-def format_count_per_sample(phenotype_to_samples: dict):
-    expr = ( pl.lit("Counts (REF / ALT / ...):<br>") )
-    for phenotype, samples in phenotype_to_samples.items():
-        expr += (pl.lit(f"  Phenotype: {phenotype}:<br>"))
-        for sample in samples:
-            ad_col = f"{sample}_AD"
-            expr += (
-                pl.lit(f"    {sample}: ")
-                + pl.when(
-                    pl.col(ad_col).is_not_null()
-                ).then(
-                    pl.col(ad_col).list.join(" / ")
-                ).otherwise(
-                    pl.lit("")
-                )
-                + pl.lit("<br>")
-            )
-    yield expr.alias("allele_counts")
-
-
 def get_window_allele_count_expr(populations: list[str]):
     for pop in populations:
         yield (
@@ -136,14 +109,48 @@ def get_window_allele_count_expr(populations: list[str]):
         ).alias(pop)
 
 
-def add_total_depth(df: pl.DataFrame) -> pl.DataFrame:
-    return df.with_columns(
-        pl.col("INFO").str.extract(r"DP=(\d+)").cast(pl.Int64).alias("total_depth")
-    )
+def add_total_depth(lf: pl.LazyFrame) -> pl.LazyFrame:
+    return lf.with_columns(pl.col("INFO_DP").alias("total_depth"))
 
 
-def get_length(lf: pl.LazyFrame) -> int:
-    return lf.select(pl.len()).collect().item(0, 0)
+def get_phenotype_to_samples(design_file: Path, samples: list[str]) -> dict[str, list[str]]:
+    design_df = pl.read_csv(design_file)
+    design_df = design_df.filter(pl.col("sample").is_in(samples))
+    return {
+        d["phenotype"]: d["sample"]
+        for d in design_df.group_by("phenotype", maintain_order=True).agg("sample").to_dicts()
+    }
+
+
+def parse_variants(
+    vcf_file: Path,
+    pvalue_file: Path,
+    phenotype_to_samples: dict[str, list[str]],
+    regions: list[tuple[str, int, int | None]] | None,
+) -> pl.LazyFrame:
+    """
+    Lazily reads the variants of a VCF file along with their p-values,
+    with the same columns and dtypes whatever the VCF file, so that they can be concatenated
+    """
+    vcf_lf = parse_typed_vcf_data(vcf_file, ["AD"], info_fields=["DP"], regions=regions)
+    # the number of variants and p-values is checked for each pair (see join_pvalues)
+    lf = join_pvalues(vcf_lf, scan_pvalues(pvalue_file), regions)
+    # samples of the design missing from this VCF file have no allele counts
+    samples = get_samples(vcf_file)
+    lf = lf.with_columns(
+        pl.lit(None, dtype=pl.List(pl.Int64)).alias(f"{sample}_AD")
+        for sample_list in phenotype_to_samples.values()
+        for sample in sample_list
+        if sample not in samples
+    )
+    return lf.select(
+        "CHROM",
+        pl.col("POS").cast(pl.Int64),
+        pl.col("QUAL").cast(pl.Float64),
+        pl.col("INFO_DP").cast(pl.Int64),
+        "pvalue",
+        get_allele_counts(phenotype_to_samples),
+    )
 
 
 #####################################################
@@ -155,6 +162,7 @@ def get_length(lf: pl.LazyFrame) -> int:
 
 def main():
     args = parse_args()
+    regions = get_regions(args)
 
     try:
         window_size = int(float(args.window_size))
@@ -162,64 +170,39 @@ def main():
     except ValueError:
         raise TypeError(f"Could not cast {args.window_size} to integer.")
 
-    logger.info("Parsing VCF file")
-    vcf1_lf = parse_vcf_data(args.vcf_file_1)
-    vcf2_lf = parse_vcf_data(args.vcf_file_2)
-
-    vcf1_df = vcf1_lf.collect()
-    vcf2_df = vcf2_lf.collect()
-
-    logger.info("Parsing p-values")
-    pvalues1_df = parse_pvalues(args.pvalue_file_1)
-    pvalues2_df = parse_pvalues(args.pvalue_file_2)
-
-    nb_variants = get_length(vcf1_lf)
-    nb_pvalues = len(pvalues1_df)
-    if nb_variants != nb_pvalues:
+    if len(args.vcf_files) != len(args.pvalue_files):
         raise ValueError(
-            f"Number of variants ({nb_variants}) and number of pvalues ({nb_pvalues}) do not match."
+            f"Number of VCF files ({len(args.vcf_files)}) and "
+            f"number of p-value files ({len(args.pvalue_files)}) do not match."
         )
 
-    vcf1_df = vcf1_df.hstack(pvalues1_df)
-    vcf2_df = vcf2_df.hstack(pvalues2_df)
-
-    vcf_df = pl.concat([vcf1_df, vcf2_df], how="vertical")
-
-    samples = [col for col in vcf_df.columns[9:] if col != "pvalue"]
-    design_df = pl.read_csv(args.design_file)
-    design_df = design_df.filter(pl.col("sample").is_in(samples))
-    phenotype_to_samples = {
-        d["phenotype"]: d['sample']
-        for d in design_df.group_by("phenotype").agg("sample").to_dicts()
-    }
-
-    AD_index = get_position_in_format(vcf_df.lazy(), "AD")
-
-    logger.info("Extracting allele depths")
-    for sample in samples:
-        vcf_df = vcf_df.with_columns(
-            pl.col(sample)
-            .str.split(":").list[AD_index]
-            .replace(".", None)
-            .str.split(",")
-            .alias(f"{sample}_AD")
-        )
+    samples = []
+    for vcf_file in args.vcf_files:
+        samples += [sample for sample in get_samples(vcf_file) if sample not in samples]
+    phenotype_to_samples = get_phenotype_to_samples(args.design_file, samples)
+
+    logger.info(f"Parsing {len(args.vcf_files)} VCF files and their p-values")
+    # VCF files are read one after the other, in a single streaming pass for both outputs
+    vcf_lf = pl.concat(
+        [
+            parse_variants(vcf_file, pvalue_file, phenotype_to_samples, regions)
+            for vcf_file, pvalue_file in zip(args.vcf_files, args.pvalue_files)
+        ],
+        how="vertical",
+    )
 
     logger.info("Associating SNPs to windows")
-    vcf_df = add_windows(vcf_df, window_size)
+    vcf_lf = add_windows(vcf_lf, window_size)
 
-    
     logger.info("Computing total depth")
-    vcf_df = add_total_depth(vcf_df)
+    lf = add_total_depth(vcf_lf).cache()
 
     logger.info(
         f"Computing quantile {QUANTILE} of pvalue for each pair of contig & window"
     )
 
-    logger.info("Saving variants")
-    variant_df = (
-        vcf_df
-        .with_columns(format_count_per_sample(phenotype_to_samples))
+    variant_lf = (
+        lf
         .rename({"CHROM": "chromosome", "POS": "position", "QUAL": "quality"})
         .select(
             [
@@ -232,11 +215,9 @@ def main():
             ]
         )
     )
-    variant_df.write_parquet(f"{args.prefix}.{VARIANTS_OUTFILE_SUFFIX}")
 
-    logger.info("Saving windows")
     window_lf = (
-        vcf_df.group_by(["CHROM", "window"])
+        lf.group_by(["CHROM", "window"])
         .agg(
             pl.col("pvalue").quantile(QUANTILE),
             pl.col("QUAL").mean().alias("quality"),
@@ -256,9 +237,20 @@ def main():
             ]
         )
     )
-    window_lf.write_parquet(f"{args.prefix}.{GROUPED_VARIANTS_OUTFILE_SUFFIX}")
-
 
+    logger.info("Saving variants and windows")
+    pl.collect_all(
+        [
+            variant_lf.sink_parquet(
+                f"{args.prefix}.{VARIANTS_OUTFILE_SUFFIX}",
+                metadata={ALLELE_COUNTS_METADATA_KEY: json.dumps(phenotype_to_samples)},
+                lazy=True,
+            ),
+            window_lf.sink_parquet(
+                f"{args.prefix}.{GROUPED_VARIANTS_OUTFILE_SUFFIX}", lazy=True
+            ),
+        ]
+    )
 
 
 if __name__ == "__main__":
@@ -2,15 +2,36 @@
 
 import argparse
 import logging
+import multiprocessing
+import os
 import sys
+import tempfile
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import polars as pl
-from common import parse_vcf_data, parse_vcf_header
+from common import (
+    add_output_arguments,
+    add_region_arguments,
+    get_indexed_contigs,
+    get_regions,
+    get_samples,
+    merge_vcf_parts,
+    parse_vcf_columns,
+    parse_vcf_data,
+    parse_typed_vcf_data,
+    parse_vcf_header,
+    write_vcf,
+    write_vcf_part,
+)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# several groups of contigs per process, so that all processes stay busy until the end
+NB_GROUPS_PER_CPU = 4
+
 
 #####################################################
 #####################################################
@@ -26,14 +47,14 @@ def parse_args():
         type=Path,
         dest="vcf_file",
         required=True,
-        help="Path to VCF file",
+        help="Path to VCF file (or VCF store)",
     )
     parser.add_argument(
         "--out",
         type=Path,
         dest="outfile",
         required=True,
-        help="Path to output VCF file",
+        help="Path to output VCF file (bgzipped and indexed when ending in .gz)",
     )
     parser.add_argument(
         "--min-depth-quantile",
@@ -49,56 +70,304 @@ def parse_args():
         default=0.9,
         help="Maximum depth quantile",
     )
+    parser.add_argument(
+        "--per-sample-depth",
+        dest="per_sample_depth",
+        action="store_true",
+        help="Compute depth thresholds per sample from FORMAT/DP instead of INFO/DP "
+        "(SNPs are kept when the depth of every sample lies within the thresholds of this sample, "
+        "samples without depth being skipped)",
+    )
+    parser.add_argument(
+        "--per-contig-depth",
+        dest="per_contig_depth",
+        action="store_true",
+        help="Compute depth thresholds per contig",
+    )
+    parser.add_argument(
+        "--cpus",
+        type=int,
+        default=1,
+        help="Number of processes filtering groups of contigs in parallel "
+        "(needs a bgzipped VCF file with a tabix / CSI index)",
+    )
+    add_region_arguments(parser)
+    add_output_arguments(parser)
     return parser.parse_args()
 
 
-def get_snps_with_too_low_depth(depth_df: pl.DataFrame, quantile: float):
-    too_low_df = depth_df.select(pl.all().lt(pl.all().quantile(quantile)))
-    return too_low_df.select(
-        (pl.sum_horizontal(pl.all() == 0) == 1).alias("not_too_low")
-    )
+def get_total_depth() -> pl.Expr:
+    return pl.col("INFO").str.extract(r"DP=(\d+);", 1).cast(pl.Int64).alias("total_depth")
 
 
-def get_snps_with_too_high_depth(depth_df: pl.DataFrame, quantile: float):
-    too_high_df = depth_df.select(pl.all().gt(pl.all().quantile(quantile)))
-    return too_high_df.select(
-        (pl.sum_horizontal(pl.all() == 0) == 1).alias("not_too_high")
-    )
+def parse_depth_data(
+    vcf_file: Path, regions: list[tuple[str, int, int | None]] | None, per_sample: bool
+) -> pl.LazyFrame:
+    """
+    Parses the VCF file (or VCF store), with FORMAT/DP decoded as <sample>_DP columns
+    when depth thresholds are computed per sample
+    """
+    if per_sample:
+        return parse_typed_vcf_data(vcf_file, ["DP"], keep_sample_columns=True, regions=regions)
+    return parse_vcf_data(vcf_file, regions)
 
 
-def get_filter_mask(
-    vcf_lf: pl.LazyFrame,
-    min_depth_quantile: float,
-    max_depth_quantile: float,
-) -> pl.Series:
-    depth_df = vcf_lf.select(
-        pl.col("INFO").str.extract(r"DP=(\d+);", 1).cast(pl.Int64).alias("total_depth")
-    ).collect()
-    nb_snps = len(depth_df)
-
-    not_too_low_depth_filter = get_snps_with_too_low_depth(
-        depth_df, quantile=min_depth_quantile
+def get_depth_keys(samples: list[str] | None, per_contig: bool) -> list[str]:
+    """
+    Columns identifying each set of depth thresholds (none when thresholds are global)
+    """
+    return (["CHROM"] if per_contig else []) + (["sample"] if samples is not None else [])
+
+
+def get_depths(
+    vcf_lf: pl.LazyFrame, samples: list[str] | None, per_contig: bool
+) -> pl.LazyFrame:
+    """
+    One depth per SNP (INFO/DP) or, when samples are given,
+    one depth per SNP and per sample (FORMAT/DP)
+    """
+    index = ["CHROM"] if per_contig else []
+    if samples is None:
+        return vcf_lf.select(*index, get_total_depth().alias("depth"))
+    return vcf_lf.select(
+        *index, *[pl.col(f"{sample}_DP").cast(pl.Int64).alias(sample) for sample in samples]
+    ).unpivot(index=index, variable_name="sample", value_name="depth")
+
+
+def get_depth_histogram(
+    vcf_lf: pl.LazyFrame, samples: list[str] | None, per_contig: bool
+) -> pl.DataFrame:
+    """
+    Counts SNPs per depth (null when missing), per contig and / or per sample if requested,
+    in a streaming pass over the VCF.
+    The histogram is exact and its size only depends on the number of distinct depths.
+    """
+    keys = get_depth_keys(samples, per_contig)
+    return (
+        get_depths(vcf_lf, samples, per_contig)
+        .group_by(*keys, "depth")
+        .agg(pl.len().alias("count"))
+        .sort(*keys, "depth", nulls_last=True)
+        .collect(engine="streaming")
     )
-    logger.info(
-        f"{nb_snps - not_too_low_depth_filter.sum().item()} SNPs show too low depth"
+
+
+def get_histogram_quantile(histogram_df: pl.DataFrame, quantile: float) -> int | None:
+    # value of rank round(q * (n - 1)) among non-missing depths, as pl.Expr.quantile does
+    histogram_df = histogram_df.drop_nulls("depth")
+    nb_values = histogram_df["count"].sum()
+    if nb_values == 0:
+        return None
+    rank = int(quantile * (nb_values - 1) + 0.5)
+    index = (histogram_df["count"].cum_sum() > rank).arg_max()
+    return histogram_df["depth"][index]
+
+
+def get_depth_thresholds(
+    histogram_df: pl.DataFrame, keys: list[str], min_quantile: float, max_quantile: float
+) -> pl.DataFrame:
+    """
+    Minimum and maximum depths for each set of keys (a single row when there is no key).
+    Thresholds are null when no depth is available.
+    """
+    if keys:
+        groups = histogram_df.partition_by(keys, maintain_order=True, as_dict=True)
+    else:
+        groups = {(): histogram_df}
+    return pl.DataFrame(
+        [
+            dict(
+                zip(keys, key),
+                min_depth=get_histogram_quantile(group_df, min_quantile),
+                max_depth=get_histogram_quantile(group_df, max_quantile),
+            )
+            for key, group_df in groups.items()
+        ],
+        schema={
+            **{key: histogram_df.schema[key] for key in keys},
+            "min_depth": pl.Int64,
+            "max_depth": pl.Int64,
+        },
     )
 
-    not_too_high_depth_filter = get_snps_with_too_high_depth(
-        depth_df, quantile=max_depth_quantile
+
+def merge_depth_histograms(histogram_dfs: list[pl.DataFrame], keys: list[str]) -> pl.DataFrame:
+    return (
+        pl.concat(histogram_dfs)
+        .group_by(*keys, "depth")
+        .agg(pl.col("count").sum())
+        .sort(*keys, "depth", nulls_last=True)
     )
 
-    logger.info(
-        f"{nb_snps - not_too_high_depth_filter.sum().item()} SNPs show too high depth"
+
+def count_variants(histogram_df: pl.DataFrame, predicate: pl.Expr) -> int:
+    return histogram_df.filter(predicate)["count"].sum()
+
+
+def is_within_thresholds(
+    depth: pl.Expr, thresholds_df: pl.DataFrame, per_contig: bool
+) -> pl.Expr:
+    # thresholds per contig are looked up from the CHROM column, without join
+    if per_contig:
+        min_depth, max_depth = (
+            pl.col("CHROM").replace_strict(
+                thresholds_df["CHROM"], thresholds_df[column], default=None, return_dtype=pl.Int64
+            )
+            for column in ["min_depth", "max_depth"]
+        )
+    else:
+        min_depth, max_depth = (
+            pl.lit(thresholds_df[column].first(), dtype=pl.Int64)
+            for column in ["min_depth", "max_depth"]
+        )
+    return depth.is_between(min_depth, max_depth)
+
+
+def get_depth_mask(
+    thresholds_df: pl.DataFrame, samples: list[str] | None, per_contig: bool
+) -> pl.Expr:
+    """
+    True for SNPs whose depth lies within the thresholds, or whose depths all lie
+    within the thresholds of their sample when thresholds are computed per sample.
+    SNPs without total depth are discarded (null mask),
+    while samples without depth are skipped when thresholds are computed per sample.
+    """
+    if samples is None:
+        return is_within_thresholds(get_total_depth(), thresholds_df, per_contig)
+    # evaluated for all samples at once, row by row
+    return pl.all_horizontal(
+        is_within_thresholds(
+            pl.col(f"{sample}_DP").cast(pl.Int64),
+            thresholds_df.filter(pl.col("sample") == sample),
+            per_contig,
+        ).fill_null(True)
+        for sample in samples
     )
 
-    return (
-        pl.concat(
-            [not_too_low_depth_filter, not_too_high_depth_filter],
-            how="horizontal",
+
+def filter_depth(
+    vcf_lf: pl.LazyFrame,
+    thresholds_df: pl.DataFrame,
+    samples: list[str] | None,
+    per_contig: bool,
+    vcf_columns: list[str],
+) -> pl.LazyFrame:
+    return vcf_lf.filter(get_depth_mask(thresholds_df, samples, per_contig)).select(vcf_columns)
+
+
+def join_depth_thresholds(
+    histogram_df: pl.DataFrame, thresholds_df: pl.DataFrame, keys: list[str]
+) -> pl.DataFrame:
+    if keys:
+        return histogram_df.join(thresholds_df, on=keys, how="left")
+    return histogram_df.join(thresholds_df, how="cross")
+
+
+def log_depth_thresholds(histogram_df: pl.DataFrame, thresholds_df: pl.DataFrame, keys: list[str]):
+    """
+    Logs the thresholds of each contig and / or sample,
+    and the number of SNPs with too low / too high depth
+    """
+    depth = pl.col("depth")
+    counts_df = (
+        join_depth_thresholds(histogram_df, thresholds_df, keys)
+        .group_by(keys, maintain_order=True)
+        .agg(
+            pl.col("min_depth").first(),
+            pl.col("max_depth").first(),
+            # SNPs without depth are counted as too low and too high, as with global thresholds
+            pl.col("count")
+            .filter(~(depth >= pl.col("min_depth")).fill_null(False))
+            .sum()
+            .alias("too_low"),
+            pl.col("count")
+            .filter(~(depth <= pl.col("max_depth")).fill_null(False))
+            .sum()
+            .alias("too_high"),
+        )
+    )
+    for row in counts_df.iter_rows(named=True):
+        prefix = " / ".join(str(row[key]) for key in keys)
+        if row["min_depth"] is None:
+            logger.warning(f"{prefix}: no depth available, all SNPs are discarded")
+            continue
+        logger.info(
+            f"{prefix}: keeping SNPs with depth between {row['min_depth']} and {row['max_depth']} "
+            f"({row['too_low']} SNPs show too low depth, "
+            f"{row['too_high']} SNPs show too high depth)"
         )
-        .select(mask=pl.all_horizontal(pl.all()))
-        .to_series()
+
+
+def get_contig_groups(contigs: dict[str, int | None], nb_groups: int) -> list[list[str]]:
+    """
+    Splits contigs into groups of consecutive contigs (in the order of the index)
+    holding about the same number of variants.
+    Contigs whose number of variants is not recorded in the index count as one variant.
+    """
+    sizes = {contig: max(nb_variants or 0, 1) for contig, nb_variants in contigs.items()}
+    group_size = sum(sizes.values()) / nb_groups
+    groups = [[]]
+    size = 0
+    for contig, contig_size in sizes.items():
+        groups[-1].append(contig)
+        size += contig_size
+        if size >= group_size:
+            groups.append([])
+            size = 0
+    return [group for group in groups if group]
+
+
+def get_group_regions(
+    group: list[str], regions: list[tuple[str, int, int | None]] | None
+) -> list[tuple[str, int, int | None]]:
+    if regions is None:
+        return [(contig, 1, None) for contig in group]
+    return [region for region in regions if region[0] in group]
+
+
+def compute_depth_histogram(
+    vcf_file: Path,
+    regions: list[tuple[str, int, int | None]],
+    samples: list[str] | None,
+    per_contig: bool,
+) -> pl.DataFrame:
+    vcf_lf = parse_depth_data(vcf_file, regions, samples is not None)
+    return get_depth_histogram(vcf_lf, samples, per_contig)
+
+
+def write_filtered_part(
+    vcf_file: Path,
+    regions: list[tuple[str, int, int | None]],
+    thresholds_df: pl.DataFrame,
+    samples: list[str] | None,
+    per_contig: bool,
+    header_lines: list[str],
+    part_file: Path,
+    index_format: str,
+):
+    vcf_lf = filter_depth(
+        parse_depth_data(vcf_file, regions, samples is not None),
+        thresholds_df,
+        samples,
+        per_contig,
+        parse_vcf_columns(vcf_file),
     )
+    return write_vcf_part(vcf_lf, header_lines, part_file, index_format)
+
+
+def get_process_pool(nb_workers: int) -> ProcessPoolExecutor:
+    # avoiding oversubscription: each worker gets a single Polars thread
+    os.environ["POLARS_MAX_THREADS"] = "1"
+    context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=nb_workers, mp_context=context)
+
+
+def run_in_parallel(executor: ProcessPoolExecutor, function, kwargs_list: list[dict]) -> list:
+    """
+    Runs function on the pool of processes, results being returned in the order of kwargs_list
+    """
+    futures = [executor.submit(function, **kwargs) for kwargs in kwargs_list]
+    return [future.result() for future in futures]
 
 
 def range_starts(lengths: pl.Series) -> pl.Series:
@@ -120,39 +389,155 @@ def range_starts(lengths: pl.Series) -> pl.Series:
 
 def main():
     args = parse_args()
+    regions = get_regions(args)
+    samples = get_samples(args.vcf_file) if args.per_sample_depth else None
+    keys = get_depth_keys(samples, args.per_contig_depth)
 
     logger.info("Parsing VCF file")
-    vcf_lf = parse_vcf_data(args.vcf_file)
+    vcf_lf = parse_depth_data(args.vcf_file, regions, args.per_sample_depth)
     vcf_header_lines = parse_vcf_header(args.vcf_file)
-    nb_original_snps = vcf_lf.select(pl.len()).collect().item()
-
-    if nb_original_snps == 0:
-        logger.info("No SNPs found in VCF file")
-        sys.exit(0)
-
-    logger.info(f"Parsed {nb_original_snps} SNPs")
-
-    logger.info("Separating read count columns")
-
-    filter_mask = get_filter_mask(
-        vcf_lf, args.min_depth_quantile, args.max_depth_quantile
-    )
-    logger.info(
-        f"Kept {filter_mask.sum()} SNPs out of {nb_original_snps} ({filter_mask.sum() / nb_original_snps:.2%})"
-    )
-
-    logger.info("Applying filters")
-    vcf_lf = vcf_lf.filter(filter_mask)
-
-    logger.info(f"Exporting fitlered VCF to {args.outfile}")
-
-    if vcf_lf.select(pl.len()).collect().item() == 0:
-        logger.info("No variants left after filtering")
-        sys.exit(0)
-
-    with open(args.outfile, "a") as fout:
-        fout.writelines(vcf_header_lines)
-        vcf_lf.collect().rename({"CHROM": "#CHROM"}).write_csv(fout, separator="\t")
+    vcf_columns = parse_vcf_columns(args.vcf_file)
+
+    # groups of contigs are read through the index and processed in parallel
+    contigs = get_indexed_contigs(args.vcf_file) if args.cpus > 1 else None
+    if args.cpus > 1 and contigs is None:
+        logger.warning(f"No index found for {args.vcf_file}: filtering in a single process")
+    group_regions = []
+    if contigs is not None:
+        for group in get_contig_groups(contigs, NB_GROUPS_PER_CPU * args.cpus):
+            if regions_of_group := get_group_regions(group, regions):
+                group_regions.append(regions_of_group)
+        if not group_regions:
+            contigs = None
+
+    # the same pool of processes runs both passes
+    process_pool = get_process_pool(args.cpus) if contigs is not None else nullcontext()
+    with process_pool as executor:
+        # first pass: depth quantiles, from the depth histogram
+        # (histograms of groups of contigs add up to the histogram of the whole VCF)
+        if contigs is not None:
+            logger.info(
+                f"Computing depth histogram on {len(group_regions)} groups of contigs "
+                f"with {args.cpus} processes"
+            )
+            histogram_df = merge_depth_histograms(
+                run_in_parallel(
+                    executor,
+                    compute_depth_histogram,
+                    [
+                        dict(
+                            vcf_file=args.vcf_file,
+                            regions=r,
+                            samples=samples,
+                            per_contig=args.per_contig_depth,
+                        )
+                        for r in group_regions
+                    ],
+                ),
+                keys,
+            )
+        else:
+            logger.info("Computing depth histogram")
+            histogram_df = get_depth_histogram(vcf_lf, samples, args.per_contig_depth)
+
+        # with thresholds per sample, each SNP is counted once per sample
+        if samples is None:
+            nb_original_snps = histogram_df["count"].sum()
+        else:
+            nb_original_snps = count_variants(histogram_df, pl.col("sample") == samples[0])
+
+        if not nb_original_snps:
+            logger.info("No SNPs found in VCF file")
+            sys.exit(0)
+
+        logger.info(f"Parsed {nb_original_snps} SNPs")
+
+        thresholds_df = get_depth_thresholds(
+            histogram_df, keys, args.min_depth_quantile, args.max_depth_quantile
+        )
+        if keys:
+            log_depth_thresholds(histogram_df, thresholds_df, keys)
+        else:
+            min_depth, max_depth = thresholds_df.row(0)
+            logger.info(f"Keeping SNPs with total depth between {min_depth} and {max_depth}")
+
+            depth = pl.col("depth")
+            logger.info(
+                f"{nb_original_snps - count_variants(histogram_df, depth >= min_depth)} SNPs show too low depth"
+            )
+            logger.info(
+                f"{nb_original_snps - count_variants(histogram_df, depth <= max_depth)} SNPs show too high depth"
+            )
+
+        # SNPs kept with thresholds on INFO/DP are known from the histogram,
+        # those kept with thresholds per sample only once they are written
+        if samples is None:
+            nb_kept_snps = count_variants(
+                join_depth_thresholds(histogram_df, thresholds_df, keys),
+                pl.col("depth").is_between(pl.col("min_depth"), pl.col("max_depth")),
+            )
+            logger.info(
+                f"Kept {nb_kept_snps} SNPs out of {nb_original_snps} ({nb_kept_snps / nb_original_snps:.2%})"
+            )
+            if nb_kept_snps == 0:
+                logger.info("No variants left after filtering")
+                sys.exit(0)
+
+        # second pass: variants are filtered and written batch by batch
+        logger.info(f"Exporting fitlered VCF to {args.outfile}")
+        if contigs is None:
+            nb_kept_snps = write_vcf(
+                filter_depth(vcf_lf, thresholds_df, samples, args.per_contig_depth, vcf_columns),
+                vcf_header_lines,
+                args.outfile,
+                args.index_format,
+            )
+        else:
+            # each group of contigs is written to its own part, parts being concatenated in order
+            with tempfile.TemporaryDirectory(dir=args.outfile.parent) as tmp_dir:
+                suffix = ".vcf.gz" if args.outfile.suffix == ".gz" else ".vcf"
+                part_files = [
+                    Path(tmp_dir) / f"part_{i:06d}{suffix}" for i in range(len(group_regions))
+                ]
+                nb_part_snps, part_indexes = zip(
+                    *run_in_parallel(
+                        executor,
+                        write_filtered_part,
+                        [
+                            dict(
+                                vcf_file=args.vcf_file,
+                                regions=r,
+                                thresholds_df=thresholds_df,
+                                samples=samples,
+                                per_contig=args.per_contig_depth,
+                                header_lines=vcf_header_lines,
+                                part_file=part_file,
+                                index_format=args.index_format,
+                            )
+                            for r, part_file in zip(group_regions, part_files)
+                        ],
+                    )
+                )
+                nb_kept_snps = sum(nb_part_snps)
+                if nb_kept_snps > 0:
+                    merge_vcf_parts(
+                        vcf_columns,
+                        vcf_header_lines,
+                        part_files,
+                        part_indexes,
+                        args.outfile,
+                        args.index_format,
+                    )
+
+    if samples is not None:
+        logger.info(
+            f"Kept {nb_kept_snps} SNPs out of {nb_original_snps} ({nb_kept_snps / nb_original_snps:.2%})"
+        )
+        if nb_kept_snps == 0:
+            # no output, as when no SNP is kept with thresholds on INFO/DP
+            for file in [args.outfile, Path(f"{args.outfile}.{args.index_format}")]:
+                file.unlink(missing_ok=True)
+            logger.info("No variants left after filtering")
 
 
 if __name__ == "__main__":
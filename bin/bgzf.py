@@ -0,0 +1,622 @@
+import gzip
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache
+from itertools import chain
+from pathlib import Path
+from typing import Iterator
+
+import polars as pl
+
+# BGZF files are series of gzip blocks of at most 64 kb,
+# each one holding its own size in the "BC" extra subfield of its header
+# see the SAM/BAM specification (section 4.1) for details
+BGZF_HEADER_SIZE = 18
+BGZF_FOOTER_SIZE = 8
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+# maximum uncompressed size of a block, as in htslib,
+# so that compressed blocks always fit in 64 kb, even for incompressible data
+BGZF_BLOCK_SIZE = 0xFF00
+BGZF_MAX_COMPRESSED_BLOCK_SIZE = 0x10000
+# empty block marking the end of the file
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+BGZF_COMPRESSION_LEVEL = 6
+
+TBI_MAGIC = b"TBI\x01"
+CSI_MAGIC = b"CSI\x01"
+# tabix indexes always use 14 bits for the smallest bins and 5 levels
+TBI_MIN_SHIFT = 14
+TBI_DEPTH = 5
+# tabix header fields for VCF files:
+# format, column of sequence names, of start positions, of end positions (none), comment char, skipped lines
+VCF_INDEX_HEADER = (2, 1, 2, 0, ord("#"), 0)
+
+# number of blocks inflated by each task (about 4 MB of uncompressed data)
+NB_BLOCKS_PER_TASK = 64
+
+
+@dataclass
+class Index:
+    """
+    Binning index of a bgzipped file (tabix or CSI).
+    For each reference, bins maps a bin number to the list of (start, end) virtual offsets
+    of the chunks of records overlapping it, and linear_index holds the smallest
+    virtual offset of records overlapping each 16 kb window (tabix only).
+    """
+
+    min_shift: int
+    depth: int
+    names: list[str]
+    bins: list[dict[int, list[tuple[int, int]]]] = field(default_factory=list)
+    linear_index: list[list[int]] = field(default_factory=list)
+
+
+def split_virtual_offset(virtual_offset: int) -> tuple[int, int]:
+    """
+    Splits a virtual offset into the offset of the block in the compressed file
+    and the offset within the uncompressed block
+    """
+    return virtual_offset >> 16, virtual_offset & 0xFFFF
+
+
+def read_block(fin, block_offset: int) -> tuple[bytes, int]:
+    """
+    Reads and inflates the block starting at block_offset.
+    Returns the uncompressed data and the offset of the next block.
+    """
+    fin.seek(block_offset)
+    header = fin.read(BGZF_HEADER_SIZE)
+    if len(header) < BGZF_HEADER_SIZE:
+        return b"", block_offset
+    if header[:4] != BGZF_MAGIC:
+        raise ValueError(f"Invalid BGZF block at offset {block_offset}")
+    block_size = struct.unpack("<H", header[16:18])[0] + 1
+    compressed_data = fin.read(block_size - BGZF_HEADER_SIZE - BGZF_FOOTER_SIZE)
+    fin.read(BGZF_FOOTER_SIZE)
+    return zlib.decompress(compressed_data, -15), block_offset + block_size
+
+
+def is_bgzf(file: Path) -> bool:
+    with open(file, "rb") as fin:
+        header = fin.read(BGZF_HEADER_SIZE)
+    # the "BC" subfield distinguishes BGZF files from plain gzip files
+    return header[:4] == BGZF_MAGIC and header[12:14] == b"BC"
+
+
+def iter_compressed_blocks(fin, nb_blocks: int) -> Iterator[list[bytes]]:
+    """
+    Splits a BGZF file at block boundaries, using the block sizes stored in the headers.
+    Yields lists of nb_blocks raw deflate streams.
+    """
+    blocks = []
+    while len(header := fin.read(BGZF_HEADER_SIZE)) == BGZF_HEADER_SIZE:
+        if header[:4] != BGZF_MAGIC:
+            raise ValueError(f"Invalid BGZF block at offset {fin.tell() - BGZF_HEADER_SIZE}")
+        block_size = struct.unpack("<H", header[16:18])[0] + 1
+        blocks.append(fin.read(block_size - BGZF_HEADER_SIZE)[:-BGZF_FOOTER_SIZE])
+        if len(blocks) == nb_blocks:
+            yield blocks
+            blocks = []
+    if blocks:
+        yield blocks
+
+
+def inflate_blocks(blocks: list[bytes]) -> bytes:
+    # zlib releases the GIL while inflating, so that tasks run in parallel in threads
+    return b"".join(zlib.decompress(block, -15) for block in blocks)
+
+
+def iter_inflated_data(file: Path, nb_threads: int) -> Iterator[bytes]:
+    """
+    Inflates the blocks of a BGZF file on a pool of threads and yields the uncompressed data in order.
+    At most 2 tasks per thread are in flight, so that memory stays bounded.
+    """
+    with open(file, "rb") as fin, ThreadPoolExecutor(max_workers=nb_threads) as executor:
+        futures = deque()
+        for blocks in iter_compressed_blocks(fin, NB_BLOCKS_PER_TASK):
+            futures.append(executor.submit(inflate_blocks, blocks))
+            if len(futures) >= 2 * nb_threads:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def compress_block(data: bytes, level: int) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed_data = compressor.compress(data) + compressor.flush()
+    block_size = BGZF_HEADER_SIZE + len(compressed_data) + BGZF_FOOTER_SIZE
+    if block_size > BGZF_MAX_COMPRESSED_BLOCK_SIZE:
+        # incompressible data are stored as is
+        return compress_block(data, 0)
+    # the "BC" subfield holds the size of the block minus 1
+    header = struct.pack("<4sIBBH2sHH", BGZF_MAGIC, 0, 0, 255, 6, b"BC", 2, block_size - 1)
+    footer = struct.pack("<II", zlib.crc32(data), len(data))
+    return header + compressed_data + footer
+
+
+def compress_blocks(data: bytes, level: int) -> list[bytes]:
+    # zlib releases the GIL while compressing, so that tasks run in parallel in threads
+    return [
+        compress_block(data[start : start + BGZF_BLOCK_SIZE], level)
+        for start in range(0, len(data), BGZF_BLOCK_SIZE)
+    ]
+
+
+class BgzfWriter:
+    """
+    Writes a BGZF file, compressing blocks on a pool of threads.
+    At most 2 tasks per thread are in flight, so that memory stays bounded.
+    Every block but the last one holds exactly BGZF_BLOCK_SIZE bytes of uncompressed data,
+    so that positions in the uncompressed data map to virtual offsets once the file is closed
+    (see get_virtual_offset).
+    """
+
+    def __init__(
+        self, file: Path, nb_threads: int, level: int = BGZF_COMPRESSION_LEVEL, eof: bool = True
+    ):
+        self.fout = open(file, "wb")
+        self.nb_threads = nb_threads
+        self.level = level
+        # files meant to be concatenated to others (see append_index) have no EOF block
+        self.eof = eof
+        self.executor = ThreadPoolExecutor(max_workers=nb_threads)
+        self.futures = deque()
+        self.buffer = bytearray()
+        # number of uncompressed bytes written so far
+        self.position = 0
+        # offset of each block in the compressed file
+        self.block_offsets = []
+        self.offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, data: bytes):
+        self.buffer += data
+        self.position += len(data)
+        task_size = NB_BLOCKS_PER_TASK * BGZF_BLOCK_SIZE
+        if len(self.buffer) >= task_size:
+            end = len(self.buffer) - len(self.buffer) % task_size
+            for start in range(0, end, task_size):
+                self.submit(bytes(self.buffer[start : start + task_size]))
+            del self.buffer[:end]
+
+    def submit(self, data: bytes):
+        self.futures.append(self.executor.submit(compress_blocks, data, self.level))
+        if len(self.futures) >= 2 * self.nb_threads:
+            self.write_blocks(self.futures.popleft().result())
+
+    def write_blocks(self, blocks: list[bytes]):
+        for block in blocks:
+            self.block_offsets.append(self.offset)
+            self.fout.write(block)
+            self.offset += len(block)
+
+    def close(self):
+        if self.fout.closed:
+            return
+        if self.buffer:
+            self.submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.futures:
+            self.write_blocks(self.futures.popleft().result())
+        self.executor.shutdown()
+        # positions at the very end of the data point to the EOF block
+        self.block_offsets.append(self.offset)
+        if self.eof:
+            self.fout.write(BGZF_EOF)
+        self.fout.close()
+
+    def get_virtual_offset(self, position: int) -> int:
+        """
+        Converts a position in the uncompressed data to a virtual offset.
+        Only valid once the blocks holding the position are written.
+        """
+        block_index, within_block_offset = divmod(position, BGZF_BLOCK_SIZE)
+        return self.block_offsets[block_index] << 16 | within_block_offset
+
+
+def iter_chunk(fin, start: int, end: int) -> Iterator[bytes]:
+    """
+    Yields uncompressed data between two virtual offsets, block by block
+    """
+    block_offset, within_block_offset = split_virtual_offset(start)
+    end_block_offset, end_within_block_offset = split_virtual_offset(end)
+    while block_offset <= end_block_offset:
+        block, next_block_offset = read_block(fin, block_offset)
+        if not block and next_block_offset == block_offset:
+            break
+        stop = end_within_block_offset if block_offset == end_block_offset else None
+        yield block[within_block_offset:stop]
+        within_block_offset = 0
+        block_offset = next_block_offset
+
+
+def read_chunk(fin, start: int, end: int) -> bytes:
+    """
+    Reads uncompressed data between two virtual offsets
+    """
+    return b"".join(iter_chunk(fin, start, end))
+
+
+def parse_names(data: bytes) -> list[str]:
+    return [name.decode("utf-8") for name in data.split(b"\x00") if name]
+
+
+def parse_tbi(data: bytes) -> Index:
+    n_ref, _, _, _, _, _, _, l_nm = struct.unpack_from("<8i", data, 4)
+    offset = 36
+    index = Index(TBI_MIN_SHIFT, TBI_DEPTH, parse_names(data[offset : offset + l_nm]))
+    offset += l_nm
+    for _ in range(n_ref):
+        bins = {}
+        (n_bin,) = struct.unpack_from("<i", data, offset)
+        offset += 4
+        for _ in range(n_bin):
+            bin_number, n_chunk = struct.unpack_from("<Ii", data, offset)
+            offset += 8
+            chunks = struct.unpack_from(f"<{2 * n_chunk}Q", data, offset)
+            offset += 16 * n_chunk
+            bins[bin_number] = list(zip(chunks[::2], chunks[1::2]))
+        (n_intv,) = struct.unpack_from("<i", data, offset)
+        offset += 4
+        index.linear_index.append(list(struct.unpack_from(f"<{n_intv}Q", data, offset)))
+        offset += 8 * n_intv
+        index.bins.append(bins)
+    return index
+
+
+def parse_csi(data: bytes) -> Index:
+    min_shift, depth, l_aux = struct.unpack_from("<3i", data, 4)
+    offset = 16
+    # for VCF files, the auxiliary data holds the tabix-like header with sequence names
+    aux = data[offset : offset + l_aux]
+    names = parse_names(aux[28:]) if l_aux >= 28 else []
+    offset += l_aux
+    index = Index(min_shift, depth, names)
+    (n_ref,) = struct.unpack_from("<i", data, offset)
+    offset += 4
+    for _ in range(n_ref):
+        bins = {}
+        (n_bin,) = struct.unpack_from("<i", data, offset)
+        offset += 4
+        for _ in range(n_bin):
+            bin_number, _, n_chunk = struct.unpack_from("<IQi", data, offset)
+            offset += 16
+            chunks = struct.unpack_from(f"<{2 * n_chunk}Q", data, offset)
+            offset += 16 * n_chunk
+            bins[bin_number] = list(zip(chunks[::2], chunks[1::2]))
+        index.bins.append(bins)
+        index.linear_index.append([])
+    return index
+
+
+def find_index_file(file: Path) -> Path | None:
+    for suffix in [".tbi", ".csi"]:
+        index_file = Path(f"{file}{suffix}")
+        if index_file.is_file():
+            return index_file
+    return None
+
+
+class IndexBuilder:
+    """
+    Builds the binning index of a bgzipped file while it is written.
+    Records must be sorted by position, with the records of each reference contiguous.
+    They are added batch by batch (see add_records), with their 0-based, half-open intervals
+    and the positions of their first byte and of the byte following them in the uncompressed data.
+    As in htslib, consecutive records of the same bin are merged into one chunk.
+    """
+
+    def __init__(self, min_shift: int = TBI_MIN_SHIFT, depth: int = TBI_DEPTH):
+        self.index = Index(min_shift, depth, [])
+        # (first position, last position, number of records) of each reference
+        self.spans = []
+        # (bin, first position, last position) of the running chunk
+        self.chunk = None
+        self.last_start = -1
+
+    def add_reference(self, name: str):
+        if name in self.index.names:
+            raise ValueError(f"Records are not sorted: reference {name} is not contiguous")
+        self.flush_chunk()
+        self.index.names.append(name)
+        self.index.bins.append({})
+        self.index.linear_index.append([])
+        self.spans.append(None)
+        self.last_start = -1
+
+    def flush_chunk(self):
+        if self.chunk is not None:
+            bin_number, chunk_start, chunk_end = self.chunk
+            self.index.bins[-1].setdefault(bin_number, []).append((chunk_start, chunk_end))
+            self.chunk = None
+
+    def add_records(self, records_df: pl.DataFrame):
+        """
+        Adds records given as a dataframe with columns
+        CHROM, start, end (0-based, half-open interval), first_byte, end_byte (positions in the uncompressed data)
+        """
+        min_shift, depth = self.index.min_shift, self.index.depth
+        max_end = records_df["end"].max()
+        if max_end is not None and max_end > 1 << (min_shift + depth * 3):
+            raise ValueError(
+                f"Position {max_end} exceeds the range covered by the index: use a CSI index"
+            )
+
+        records_df = records_df.with_columns(
+            reg2bin(pl.col("start"), pl.col("end"), min_shift, depth).alias("bin"),
+            pl.col("CHROM").rle_id().alias("reference_run"),
+        )
+        for reference_df in records_df.partition_by("reference_run", maintain_order=True):
+            name = reference_df["CHROM"][0]
+            if not self.index.names or name != self.index.names[-1]:
+                self.add_reference(name)
+            starts = reference_df["start"]
+            if starts[0] < self.last_start or not starts.is_sorted():
+                raise ValueError(f"Records are not sorted by position on reference {name}")
+            self.last_start = starts[-1]
+            self.add_chunks(reference_df)
+            self.add_linear_offsets(reference_df)
+
+            span = self.spans[-1]
+            first_byte = span[0] if span is not None else reference_df["first_byte"][0]
+            nb_records = (span[2] if span is not None else 0) + reference_df.height
+            self.spans[-1] = (first_byte, reference_df["end_byte"][-1], nb_records)
+
+    def add_chunks(self, reference_df: pl.DataFrame):
+        runs_df = reference_df.group_by(
+            pl.col("bin").rle_id().alias("bin_run"), maintain_order=True
+        ).agg(pl.col("bin").first(), pl.col("first_byte").first(), pl.col("end_byte").last())
+        for bin_number, first_byte, end_byte in runs_df.select(
+            "bin", "first_byte", "end_byte"
+        ).iter_rows():
+            if self.chunk is not None and self.chunk[0] == bin_number:
+                self.chunk = (bin_number, self.chunk[1], end_byte)
+            else:
+                self.flush_chunk()
+                self.chunk = (bin_number, first_byte, end_byte)
+
+    def add_linear_offsets(self, reference_df: pl.DataFrame):
+        # smallest position of the records overlapping each window of 2^min_shift bases
+        min_shift = self.index.min_shift
+        windows_df = (
+            reference_df.select(
+                pl.int_ranges(
+                    pl.col("start") // (1 << min_shift), (pl.col("end") - 1) // (1 << min_shift) + 1
+                ).alias("window"),
+                "first_byte",
+            )
+            .explode("window")
+            .group_by("window")
+            .agg(pl.col("first_byte").min())
+        )
+        linear_index = self.index.linear_index[-1]
+        for window, first_byte in windows_df.iter_rows():
+            if window >= len(linear_index):
+                linear_index.extend([None] * (window + 1 - len(linear_index)))
+            # records of previous batches come first in the file
+            if linear_index[window] is None:
+                linear_index[window] = first_byte
+
+    def finish(self, writer: BgzfWriter) -> Index:
+        """
+        Converts positions to virtual offsets, once all the data is written to the BGZF writer
+        """
+        self.flush_chunk()
+        get_virtual_offset = writer.get_virtual_offset
+        pseudo_bin = get_pseudo_bin(self.index.depth)
+        for ref_id, bins in enumerate(self.index.bins):
+            for bin_number, chunks in bins.items():
+                bins[bin_number] = [
+                    (get_virtual_offset(start), get_virtual_offset(end)) for start, end in chunks
+                ]
+            first_byte, end_byte, nb_records = self.spans[ref_id]
+            bins[pseudo_bin] = [
+                (get_virtual_offset(first_byte), get_virtual_offset(end_byte)),
+                (nb_records, 0),
+            ]
+            # as in htslib, windows without records point to the previous window,
+            # or to the first record of the reference
+            linear_index = self.index.linear_index[ref_id]
+            last_offset = get_virtual_offset(first_byte)
+            for window, first_byte in enumerate(linear_index):
+                if first_byte is not None:
+                    last_offset = get_virtual_offset(first_byte)
+                linear_index[window] = last_offset
+        return self.index
+
+
+def serialize_names(names: list[str]) -> bytes:
+    return b"".join(name.encode("utf-8") + b"\x00" for name in names)
+
+
+def serialize_chunks(chunks: list[tuple[int, int]]) -> bytes:
+    return struct.pack(f"<{2 * len(chunks)}Q", *chain.from_iterable(chunks))
+
+
+def serialize_tbi(index: Index) -> bytes:
+    names = serialize_names(index.names)
+    data = [TBI_MAGIC, struct.pack("<8i", len(index.names), *VCF_INDEX_HEADER, len(names)), names]
+    for bins, linear_index in zip(index.bins, index.linear_index):
+        data.append(struct.pack("<i", len(bins)))
+        for bin_number, chunks in bins.items():
+            data.append(struct.pack("<Ii", bin_number, len(chunks)))
+            data.append(serialize_chunks(chunks))
+        data.append(struct.pack(f"<i{len(linear_index)}Q", len(linear_index), *linear_index))
+    # number of records without coordinates
+    data.append(struct.pack("<Q", 0))
+    return b"".join(data)
+
+
+def serialize_csi(index: Index) -> bytes:
+    names = serialize_names(index.names)
+    aux = struct.pack("<7i", *VCF_INDEX_HEADER, len(names)) + names
+    data = [CSI_MAGIC, struct.pack("<3i", index.min_shift, index.depth, len(aux)), aux]
+    data.append(struct.pack("<i", len(index.names)))
+    pseudo_bin = get_pseudo_bin(index.depth)
+    for bins, linear_index in zip(index.bins, index.linear_index):
+        data.append(struct.pack("<i", len(bins)))
+        for bin_number, chunks in bins.items():
+            # smallest offset of the records overlapping the first window of the bin
+            level = next(
+                level for level in range(index.depth, -1, -1) if bin_number >= get_bin_first(level)
+            )
+            first_window = (bin_number - get_bin_first(level)) << ((index.depth - level) * 3)
+            loff = 0
+            if bin_number != pseudo_bin and first_window < len(linear_index):
+                loff = linear_index[first_window]
+            data.append(struct.pack("<IQi", bin_number, loff, len(chunks)))
+            data.append(serialize_chunks(chunks))
+    data.append(struct.pack("<Q", 0))
+    return b"".join(data)
+
+
+def get_nb_records(index: Index) -> list[int | None]:
+    """
+    Number of records of each reference, as recorded in the pseudo-bins (None when absent)
+    """
+    pseudo_bin = get_pseudo_bin(index.depth)
+    return [
+        bins[pseudo_bin][1][0] if pseudo_bin in bins else None for bins in index.bins
+    ]
+
+
+def append_index(index: Index, part_index: Index, offset: int):
+    """
+    Appends the references of part_index to index, for a BGZF file
+    concatenated at the given offset of the file indexed by index
+    """
+    shift = offset << 16
+    pseudo_bin = get_pseudo_bin(part_index.depth)
+    for name, bins, linear_index in zip(
+        part_index.names, part_index.bins, part_index.linear_index
+    ):
+        if name in index.names:
+            raise ValueError(f"Reference {name} is found in several parts")
+        index.names.append(name)
+        index.bins.append(
+            {
+                bin_number: [(start + shift, end + shift) for start, end in chunks]
+                for bin_number, chunks in bins.items()
+            }
+        )
+        if pseudo_bin in bins:
+            # only the span of the pseudo-bin is an offset, not the number of records
+            index.bins[-1][pseudo_bin][1] = bins[pseudo_bin][1]
+        index.linear_index.append([voffset + shift for voffset in linear_index])
+
+
+def write_index(index: Index, index_file: Path):
+    # index files are themselves BGZF-compressed
+    data = serialize_csi(index) if index_file.suffix == ".csi" else serialize_tbi(index)
+    with BgzfWriter(index_file, nb_threads=1) as writer:
+        writer.write(data)
+
+
+@lru_cache
+def parse_index(index_file: Path) -> Index:
+    # index files are themselves BGZF-compressed
+    with gzip.open(index_file, "rb") as fin:
+        data = fin.read()
+    if data[:4] == TBI_MAGIC:
+        return parse_tbi(data)
+    if data[:4] == CSI_MAGIC:
+        return parse_csi(data)
+    raise ValueError(f"Unrecognised index format: {index_file}")
+
+
+def get_bin_first(level: int) -> int:
+    return ((1 << (level * 3)) - 1) // 7
+
+
+def get_pseudo_bin(depth: int) -> int:
+    # bin holding the span and number of records of each reference, as written by htslib
+    return get_bin_first(depth + 1) + 1
+
+
+def get_csi_depth(max_length: int, min_shift: int = TBI_MIN_SHIFT) -> int:
+    """
+    Smallest number of levels covering max_length (as computed by bcftools index)
+    """
+    depth = 0
+    while max_length + 256 > 1 << (min_shift + depth * 3):
+        depth += 1
+    return depth
+
+
+def reg2bin(start: pl.Expr, end: pl.Expr, min_shift: int, depth: int) -> pl.Expr:
+    """
+    Smallest bin fully containing the 0-based, half-open interval [start, end)
+    (reg2bin() of htslib)
+    """
+    end = end - 1
+    bin_number = pl.lit(0, dtype=pl.UInt32)
+    shift = min_shift + depth * 3
+    for level in range(1, depth + 1):
+        shift -= 3
+        bin_number = (
+            pl.when(start // (1 << shift) == end // (1 << shift))
+            .then(get_bin_first(level) + start // (1 << shift))
+            .otherwise(bin_number)
+            .cast(pl.UInt32)
+        )
+    return bin_number
+
+
+def reg2bins(start: int, end: int, min_shift: int, depth: int) -> list[int]:
+    """
+    Lists the bins overlapping the 0-based, half-open interval [start, end)
+    (reg2bins() of htslib)
+    """
+    bins = []
+    end -= 1
+    shift = min_shift + depth * 3
+    first_bin_of_level = 0
+    for level in range(depth + 1):
+        bins += range(
+            first_bin_of_level + (start >> shift), first_bin_of_level + (end >> shift) + 1
+        )
+        shift -= 3
+        first_bin_of_level += 1 << (level * 3)
+    return bins
+
+
+def query_chunks(index: Index, contig: str, start: int, end: int) -> list[tuple[int, int]]:
+    """
+    Lists the merged (start, end) virtual offsets of the chunks that may contain
+    records overlapping the 0-based, half-open interval [start, end) of contig
+    """
+    if contig not in index.names:
+        return []
+    ref_id = index.names.index(contig)
+    # positions beyond the range covered by the index are clipped
+    end = min(end, 1 << (index.min_shift + index.depth * 3))
+    start = min(start, end - 1)
+
+    bins = index.bins[ref_id]
+    linear_index = index.linear_index[ref_id]
+    window = start >> TBI_MIN_SHIFT
+    min_offset = linear_index[min(window, len(linear_index) - 1)] if linear_index else 0
+
+    # large regions span many more bins than the reference holds
+    bin_numbers = set(reg2bins(start, end, index.min_shift, index.depth)).intersection(bins)
+    chunks = sorted(
+        chunk
+        for bin_number in bin_numbers
+        for chunk in bins[bin_number]
+        if chunk[1] > min_offset
+    )
+    merged_chunks = []
+    for chunk_start, chunk_end in chunks:
+        if merged_chunks and chunk_start <= merged_chunks[-1][1]:
+            merged_chunks[-1] = (merged_chunks[-1][0], max(merged_chunks[-1][1], chunk_end))
+        else:
+            merged_chunks.append((chunk_start, chunk_end))
+    return merged_chunks
@@ -1,12 +1,107 @@
 import gzip
+import io
+import logging
+import re
+import shutil
+from functools import lru_cache
 from pathlib import Path
+from typing import Callable, Iterator
 
+import numpy as np
 import polars as pl
+from bgzf import (
+    BGZF_EOF,
+    TBI_DEPTH,
+    TBI_MIN_SHIFT,
+    BgzfWriter,
+    Index,
+    IndexBuilder,
+    find_index_file,
+    get_csi_depth,
+    is_bgzf,
+    iter_inflated_data,
+    append_index,
+    get_nb_records,
+    iter_chunk,
+    parse_index,
+    query_chunks,
+    write_index,
+)
+from polars.io.plugins import register_io_source
+
+logger = logging.getLogger(__name__)
+
+# dtypes of the INFO / FORMAT fields, as declared in the VCF header
+VCF_TYPES_TO_POLARS_DTYPES = {
+    "Integer": pl.Int64,
+    "Float": pl.Float64,
+    "String": pl.String,
+    "Character": pl.String,
+    "Flag": pl.Boolean,
+}
+
+FIELD_DEFINITION_REGEX = re.compile(
+    r"^##(?P<kind>INFO|FORMAT)=<ID=(?P<id>[^,>]+),Number=(?P<number>[^,>]+),Type=(?P<type>[^,>]+)"
+)
+
+VCF_BASE_COLUMNS = ["CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT"]
+
+# a VCF store is a directory holding the VCF header and the variants as parquet files
+# (see convert_vcf_to_parquet.py)
+VCF_STORE_HEADER_FILE = "header.vcf"
+VCF_STORE_PART_PATTERN = "part-*.parquet"
+INFO_COLUMN_PREFIX = "INFO_"
+
+# layouts of the RO / AO count files (see sink_counts)
+COUNT_LAYOUTS = ["dense", "compact", "sparse"]
+COUNT_DTYPE = pl.UInt32
+COUNT_LAYOUT_METADATA_KEY = "count_layout"
+COUNT_SAMPLES_METADATA_KEY = "samples"
+
+# p-value files written as parquet hold the index of each variant (its row in the count files)
+PVALUE_KEY_COLUMN = "variant"
+
+# the samples of the allele_counts column of formated variants (see get_allele_counts)
+# are stored by phenotype in the parquet metadata, as JSON
+ALLELE_COUNTS_METADATA_KEY = "allele_counts_phenotypes"
+
+# values below this bound share the lowest bucket of quantile sketches (see build_quantile_sketches)
+SKETCH_MIN_VALUE = 1e-300
+SKETCH_BUCKET_COLUMN = "bucket"
+SKETCH_COUNT_COLUMN = "count"
+
+# number of records used to infer the dtype of QUAL, as pl.scan_csv does
+INFER_SCHEMA_LENGTH = 100
+# size of the batches read from VCF files that are not bgzipped
+READ_BATCH_SIZE = 4 * 1024 * 1024
+
+# bgzipped outputs (.gz) are indexed while they are written
+INDEX_FORMATS = ["tbi", "csi"]
+CONTIG_LENGTH_REGEX = re.compile(r"^##contig=<.*?ID=(?P<contig>[^,>]+).*?length=(?P<length>\d+)")
+
+# space between contigs laid on a single axis (see overlaps_regions)
+CONTIG_AXIS_SPACING = 2**40
+# regions are (contig, start, end) tuples, 1-based and inclusive;
+# an end set to None extends the region to the end of the contig
+REGION_REGEX = re.compile(r"^(?P<contig>.+?)(?::(?P<start>[\d,]+)(?:-(?P<end>[\d,]*))?)?$")
+
+
+def is_vcf_store(vcf_file: Path) -> bool:
+    return Path(vcf_file).is_dir() and (Path(vcf_file) / VCF_STORE_HEADER_FILE).is_file()
+
+
+def open_vcf(vcf_file: Path):
+    if is_vcf_store(vcf_file):
+        return open(Path(vcf_file) / VCF_STORE_HEADER_FILE, "rb")
+    # VCF files can be either bgzipped / gzipped or plain text
+    with open(vcf_file, "rb") as fin:
+        is_gzipped = fin.read(2) == b"\x1f\x8b"
+    return gzip.open(vcf_file, "rb") if is_gzipped else open(vcf_file, "rb")
 
 
 def parse_vcf_header(vcf_file: Path) -> list:
     header_lines = []
-    with gzip.open(vcf_file, "rb") as fin:
+    with open_vcf(vcf_file) as fin:
         for line in fin:
             line = line.decode("utf-8")
             if line.startswith("##"):
@@ -16,29 +111,1192 @@ def parse_vcf_header(vcf_file: Path) -> list:
     return header_lines
 
 
-def parse_vcf_data(vcf_file: Path) -> pl.LazyFrame:
-    return pl.scan_csv(
-        vcf_file, separator="\t", has_header=True, comment_prefix="##", low_memory=True
-    ).rename({"#CHROM": "CHROM"})
-
-
-def get_position_in_format(vcf_lf: pl.LazyFrame, info: str) -> int:
-    fmt_series = vcf_lf.select("FORMAT").collect().to_series()
-    #if fmt_series.unique().len() > 1:
-    #    raise ValueError(f"More than one format found: {fmt_series.unique()}")
-    fmt_series.unique()
-    if len(fmt_series.unique()) > 1:
-        # take the fmt that has the most fields (i.e. the longest)
-        fmts = sorted(fmt_series.unique().to_list(), key=lambda x: len(x.split(":")))[::-1]
-        fmt = fmts[0]
+def parse_vcf_columns(vcf_file: Path) -> list[str]:
+    """
+    Reads column names from the #CHROM line, without parsing any variant
+    """
+    with open_vcf(vcf_file) as fin:
+        for line in fin:
+            line = line.decode("utf-8")
+            if not line.startswith("##"):
+                return ["CHROM"] + line.rstrip("\n").split("\t")[1:]
+    raise ValueError(f"No #CHROM line found in {vcf_file}")
+
+
+def get_samples(vcf_file: Path) -> list[str]:
+    return parse_vcf_columns(vcf_file)[len(VCF_BASE_COLUMNS):]
+
+
+def parse_field_definitions(header_lines: list[str], kind: str) -> dict[str, dict]:
+    """
+    Parses ##INFO or ##FORMAT lines of the header into a mapping ID -> {"number": Number, "type": Type}
+    """
+    definitions = {}
+    for line in header_lines:
+        match = FIELD_DEFINITION_REGEX.match(line)
+        if match and match["kind"] == kind:
+            definitions[match["id"]] = {
+                "number": match["number"],
+                "type": match["type"],
+            }
+    return definitions
+
+
+def get_field_dtype(definition: dict | None) -> pl.DataType:
+    # fields without any definition in the header are kept as strings
+    if definition is None:
+        return pl.String
+    dtype = VCF_TYPES_TO_POLARS_DTYPES.get(definition["type"], pl.String)
+    if definition["number"] in ["0", "1"]:
+        return dtype
+    return pl.List(dtype)
+
+
+def scan_vcf_store(vcf_store: Path) -> pl.LazyFrame:
+    # parts are numbered in the order of the original VCF
+    return pl.scan_parquet(Path(vcf_store) / VCF_STORE_PART_PATTERN)
+
+
+def get_vcf_schema(vcf_file: Path) -> dict[str, pl.DataType]:
+    """
+    Dtypes of the raw VCF columns: strings, except POS and QUAL,
+    the dtype of QUAL being inferred from the first records as in a full scan with pl.scan_csv
+    """
+    columns = parse_vcf_columns(vcf_file)
+    first_lines = []
+    with open_vcf(vcf_file) as fin:
+        for line in fin:
+            if not line.startswith(b"#"):
+                first_lines.append(line)
+            if len(first_lines) == INFER_SCHEMA_LENGTH:
+                break
+    schema = {col: pl.String for col in columns}
+    schema["POS"] = pl.Int64
+    schema["QUAL"] = pl.Float64
+    if first_lines:
+        schema["QUAL"] = pl.read_csv(
+            io.BytesIO(b"".join(first_lines)),
+            separator="\t",
+            has_header=False,
+            new_columns=columns,
+            infer_schema_length=INFER_SCHEMA_LENGTH,
+        ).schema["QUAL"]
+    return schema
+
+
+def parse_vcf_lines(
+    data: bytes, schema: dict[str, pl.DataType], columns: list[str] | None = None
+) -> pl.DataFrame:
+    """
+    Parses complete VCF records (without header) into raw columns
+    """
+    if not data:
+        return pl.DataFrame(schema=schema).select(columns or list(schema))
+    return pl.read_csv(
+        io.BytesIO(data),
+        separator="\t",
+        has_header=False,
+        schema=schema,
+        # without header, columns are selected by index
+        columns=[list(schema).index(col) for col in columns] if columns else None,
+        quote_char=None,
+    )
+
+
+def iter_vcf_data(vcf_file: Path) -> Iterator[bytes]:
+    # bgzipped files are inflated in parallel, on as many threads as Polars uses
+    if is_bgzf(vcf_file):
+        yield from iter_inflated_data(vcf_file, pl.thread_pool_size())
+        return
+    with open_vcf(vcf_file) as fin:
+        while data := fin.read(READ_BATCH_SIZE):
+            yield data
+
+
+def iter_vcf_batches(
+    vcf_file: Path, columns: list[str] | None = None, vcf_data: Iterator[bytes] | None = None
+) -> Iterator[pl.DataFrame]:
+    """
+    Parses a VCF file batch by batch, in the order of the file.
+    Blocks of bgzipped files are inflated on a pool of POLARS_MAX_THREADS threads.
+    Only the requested columns are parsed.
+    The uncompressed data can be given through vcf_data (see iter_indexed_vcf_data).
+    """
+    schema = get_vcf_schema(vcf_file)
+    remainder = b""
+    if vcf_data is None:
+        vcf_data = iter_vcf_data(vcf_file)
+    for data in vcf_data:
+        data = remainder + data
+        # batches are cut after the last complete record
+        end = data.rfind(b"\n") + 1
+        data, remainder = data[:end], data[end:]
+        while data.startswith(b"#"):
+            data = data[data.index(b"\n") + 1 :]
+        if data:
+            yield parse_vcf_lines(data, schema, columns)
+    # last record without trailing newline
+    if remainder and not remainder.startswith(b"#"):
+        yield parse_vcf_lines(remainder, schema, columns)
+
+
+def scan_vcf_batches(
+    vcf_file: Path, get_vcf_data: Callable[[], Iterator[bytes]] | None = None
+) -> pl.LazyFrame:
+    """
+    Lazy frame over iter_vcf_batches, so that Polars streams the batches
+    and pushes projections / filters down to the parser
+    """
+    schema = get_vcf_schema(vcf_file)
+
+    def read_batches(
+        with_columns: list[str] | None,
+        predicate: pl.Expr | None,
+        n_rows: int | None,
+        batch_size: int | None,
+    ) -> Iterator[pl.DataFrame]:
+        columns = None
+        if with_columns is not None:
+            columns = list(with_columns)
+            if predicate is not None:
+                columns += predicate.meta.root_names()
+            columns = [col for col in schema if col in columns]
+        nb_rows = 0
+        vcf_data = get_vcf_data() if get_vcf_data is not None else None
+        for batch_df in iter_vcf_batches(vcf_file, columns, vcf_data):
+            if predicate is not None:
+                batch_df = batch_df.filter(predicate)
+            if with_columns is not None:
+                batch_df = batch_df.select(with_columns)
+            if n_rows is not None:
+                batch_df = batch_df.head(n_rows - nb_rows)
+            nb_rows += batch_df.height
+            yield batch_df
+            if n_rows is not None and nb_rows >= n_rows:
+                return
+
+    return register_io_source(read_batches, schema=schema)
+
+
+def parse_region(region: str) -> tuple[str, int, int | None]:
+    """
+    Parses a region given as chr, chr:start, chr:start- or chr:start-end (1-based, inclusive)
+    """
+    match = REGION_REGEX.match(region.strip())
+    if match is None:
+        raise ValueError(f"Invalid region: {region}")
+    start = int(match["start"].replace(",", "")) if match["start"] else 1
+    end = int(match["end"].replace(",", "")) if match["end"] else None
+    if end is not None and end < start:
+        raise ValueError(f"Invalid region: {region} (end is lower than start)")
+    return match["contig"], start, end
+
+
+def parse_regions_file(regions_file: Path) -> list[tuple[str, int, int | None]]:
+    """
+    Parses a tab-delimited file of regions with columns CHROM, POS or CHROM, START, END.
+    Positions are 1-based and inclusive, except for BED files (0-based, half-open).
+    """
+    is_bed = Path(regions_file).name.removesuffix(".gz").endswith(".bed")
+    opener = gzip.open if Path(regions_file).suffix == ".gz" else open
+    regions = []
+    with opener(regions_file, "rt") as fin:
+        for line in fin:
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            start = int(fields[1]) + is_bed
+            end = int(fields[2]) if len(fields) > 2 else start
+            regions.append((fields[0], start, end))
+    return regions
+
+
+def add_region_arguments(parser):
+    parser.add_argument(
+        "--region",
+        type=str,
+        dest="regions",
+        action="append",
+        help="Restrict to a region (chr, chr:start-end, 1-based, inclusive). Can be given several times",
+    )
+    parser.add_argument(
+        "--regions-file",
+        type=Path,
+        dest="regions_file",
+        help="Restrict to the regions listed in a file (CHROM, POS or CHROM, START, END; BED files are accepted)",
+    )
+
+
+def add_output_arguments(parser):
+    parser.add_argument(
+        "--index-format",
+        type=str,
+        dest="index_format",
+        choices=INDEX_FORMATS,
+        default="tbi",
+        help="Format of the index built along bgzipped outputs (.gz). "
+        "CSI indexes are needed for contigs longer than 2^29 bases",
+    )
+
+
+def get_regions(args) -> list[tuple[str, int, int | None]] | None:
+    """
+    Gathers regions passed through --region / --regions-file (see add_region_arguments).
+    Returns None when no restriction was requested.
+    """
+    if not args.regions and not args.regions_file:
+        return None
+    regions = [parse_region(region) for region in args.regions or []]
+    if args.regions_file:
+        regions += parse_regions_file(args.regions_file)
+    return regions
+
+
+def merge_regions(
+    regions: list[tuple[str, int, int | None]],
+) -> dict[str, list[tuple[int, int | None]]]:
+    """
+    Groups regions by contig and merges overlapping ones, so that no variant is read twice
+    """
+    merged_regions = {}
+    for contig, start, end in sorted(regions, key=lambda r: (r[0], r[1])):
+        intervals = merged_regions.setdefault(contig, [])
+        if intervals and (intervals[-1][1] is None or start <= intervals[-1][1] + 1):
+            previous_start, previous_end = intervals[-1]
+            merged_end = None if None in [previous_end, end] else max(previous_end, end)
+            intervals[-1] = (previous_start, merged_end)
+        else:
+            intervals.append((start, end))
+    return merged_regions
+
+
+def overlaps_regions(regions: list[tuple[str, int, int | None]]) -> pl.Expr:
+    """
+    Boolean expression telling whether each variant (from POS to POS + len(REF) - 1)
+    overlaps at least one of the regions.
+    """
+    merged_regions = merge_regions(regions)
+    # contigs are laid one after the other on a single axis,
+    # so that variants of all contigs are matched to intervals at once
+    contig_offsets = {
+        contig: rank * CONTIG_AXIS_SPACING for rank, contig in enumerate(merged_regions)
+    }
+    starts = pl.Series(
+        [
+            contig_offsets[contig] + start
+            for contig, intervals in merged_regions.items()
+            for start, _ in intervals
+        ],
+        dtype=pl.Int64,
+    )
+    ends = pl.Series(
+        [
+            contig_offsets[contig] + (end if end is not None else CONTIG_AXIS_SPACING - 1)
+            for contig, intervals in merged_regions.items()
+            for _, end in intervals
+        ],
+        dtype=pl.Int64,
+    )
+
+    def get_mask(variants: pl.Series) -> pl.Series:
+        variants_df = variants.struct.unnest()
+        # variants on other contigs get a null offset
+        offsets = variants_df["CHROM"].replace_strict(
+            contig_offsets, default=None, return_dtype=pl.Int64
+        )
+        # merged intervals are sorted and disjoint:
+        # only the last one starting before the end of the variant may overlap it
+        last_idx = starts.search_sorted(offsets + variants_df["END"], side="right")
+        last_idx = last_idx.cast(pl.Int64) - 1
+        overlapping = (last_idx >= 0) & (
+            ends.gather(last_idx.clip(lower_bound=0)) >= offsets + variants_df["POS"]
+        )
+        return overlapping.fill_null(False)
+
+    return pl.struct(
+        "CHROM", "POS", END=pl.col("POS") + pl.col("REF").str.len_bytes() - 1
+    ).map_batches(get_mask, return_dtype=pl.Boolean, is_elementwise=True)
+
+
+def read_indexed_vcf_regions(
+    vcf_file: Path, index_file: Path, regions: list[tuple[str, int, int | None]]
+) -> pl.LazyFrame:
+    """
+    Reads only the BGZF blocks that hold variants of the regions, using the tabix / CSI index
+    """
+    index = parse_index(index_file)
+    merged_regions = merge_regions(regions)
+
+    chunks = []
+    for contig, intervals in merged_regions.items():
+        if contig not in index.names:
+            logger.warning(f"Contig {contig} not found in index {index_file}")
+            continue
+        for start, end in intervals:
+            chunks += query_chunks(index, contig, start - 1, end if end is not None else 2**62)
+
+    # chunks are read lazily, batch by batch, so that whole contigs can be read in bounded memory
+    return scan_vcf_batches(vcf_file, lambda: iter_indexed_vcf_data(vcf_file, chunks))
+
+
+def iter_indexed_vcf_data(vcf_file: Path, chunks: list[tuple[int, int]]) -> Iterator[bytes]:
+    # chunks are read in the order of the file, and each block only once
+    # even when neighbouring regions share it
+    data = []
+    data_size = 0
+    last_chunk_end = 0
+    with open(vcf_file, "rb") as fin:
+        for chunk_start, chunk_end in sorted(chunks):
+            chunk_start = max(chunk_start, last_chunk_end)
+            if chunk_start >= chunk_end:
+                continue
+            last_chunk_end = chunk_end
+            for block_data in iter_chunk(fin, chunk_start, chunk_end):
+                data.append(block_data)
+                data_size += len(block_data)
+                if data_size >= READ_BATCH_SIZE:
+                    yield b"".join(data)
+                    data = []
+                    data_size = 0
+    if data:
+        yield b"".join(data)
+
+
+def parse_vcf_data(
+    vcf_file: Path, regions: list[tuple[str, int, int | None]] | None = None
+) -> pl.LazyFrame:
+    """
+    Parses the VCF file (or VCF store) as raw string columns.
+    Bgzipped VCF files are inflated in parallel (see iter_vcf_batches).
+    When regions are given, only variants overlapping them are kept;
+    for bgzipped VCF files with a .tbi / .csi index, only the corresponding blocks are read.
+    """
+    if is_vcf_store(vcf_file):
+        vcf_lf = scan_vcf_store(vcf_file).select(parse_vcf_columns(vcf_file))
+    elif regions is not None and (index_file := find_index_file(vcf_file)) is not None:
+        vcf_lf = read_indexed_vcf_regions(vcf_file, index_file, regions)
     else:
-        fmt = fmt_series.unique().item()
-    return fmt.split(":").index(info)
+        if regions is not None:
+            logger.warning(f"No index found for {vcf_file}: scanning the whole file")
+        if is_bgzf(vcf_file):
+            vcf_lf = scan_vcf_batches(vcf_file)
+        else:
+            vcf_lf = pl.scan_csv(
+                vcf_file, separator="\t", has_header=True, comment_prefix="##", low_memory=True
+            ).rename({"#CHROM": "CHROM"})
+    if regions is None:
+        return vcf_lf
+    contigs = list({contig for contig, _, _ in regions})
+    return vcf_lf.filter(pl.col("CHROM").is_in(contigs)).filter(overlaps_regions(regions))
+
+
+def get_contig_lengths(header_lines: list[str]) -> dict[str, int]:
+    return {
+        match["contig"]: int(match["length"])
+        for line in header_lines
+        if (match := CONTIG_LENGTH_REGEX.match(line))
+    }
+
+
+def get_indexed_contigs(vcf_file: Path) -> dict[str, int | None] | None:
+    """
+    Contigs of a bgzipped VCF file, in the order of its tabix / CSI index,
+    with their number of records when recorded by the index.
+    Returns None when the file is not indexed.
+    """
+    if is_vcf_store(vcf_file) or not is_bgzf(vcf_file):
+        return None
+    index_file = find_index_file(vcf_file)
+    if index_file is None:
+        return None
+    index = parse_index(index_file)
+    return dict(zip(index.names, get_nb_records(index)))
+
+
+def get_contig_ranges(
+    vcf_lf: pl.LazyFrame | pl.DataFrame, column: str = "CHROM"
+) -> pl.DataFrame:
+    """
+    Row ranges (offset, length) of the runs of consecutive variants on the same contig, in order,
+    found in a single streaming pass over the contig column.
+    Each contig holds a single range in sorted VCF files.
+    """
+    return (
+        vcf_lf.lazy()
+        .select(column)
+        .with_row_index("offset")
+        .group_by(pl.col(column).rle_id().alias("run"), maintain_order=True)
+        .agg(pl.col(column).first(), pl.col("offset").first(), pl.len().alias("length"))
+        .drop("run")
+        .collect(engine="streaming")
+    )
+
+
+def partition_by_contig(vcf_df: pl.DataFrame, column: str = "CHROM") -> dict[str, pl.DataFrame]:
+    """
+    Splits variants into one frame per contig, in order of first appearance.
+    Contigs held in a single range (sorted VCF files) are zero-copy slices,
+    variants of unsorted VCF files are gathered with partition_by.
+    """
+    ranges_df = get_contig_ranges(vcf_df, column)
+    if ranges_df[column].is_duplicated().any():
+        return {
+            contig: contig_df
+            for (contig,), contig_df in vcf_df.partition_by(
+                column, maintain_order=True, as_dict=True
+            ).items()
+        }
+    return {
+        contig: vcf_df.slice(offset, length) for contig, offset, length in ranges_df.iter_rows()
+    }
+
+
+def get_index_builder(header_lines: list[str], index_format: str) -> IndexBuilder:
+    depth = TBI_DEPTH
+    if index_format == "csi":
+        contig_lengths = get_contig_lengths(header_lines)
+        if contig_lengths:
+            depth = get_csi_depth(max(contig_lengths.values()), TBI_MIN_SHIFT)
+    return IndexBuilder(TBI_MIN_SHIFT, depth)
+
+
+def write_vcf_records(
+    vcf_lf: pl.LazyFrame,
+    fout,
+    index_builder: IndexBuilder | None = None,
+    other_sinks: list[pl.LazyFrame] | None = None,
+) -> int:
+    """
+    Writes variants (raw VCF columns, CHROM being renamed #CHROM) batch by batch
+    to a binary file or a BgzfWriter, adding them to the index when an index builder is given.
+    Other sinks (lazy sinks sharing a cached part of the query) are run in the same pass.
+    Returns the number of variants written.
+    """
+    nb_variants = 0
+
+    def write_batch(batch_df: pl.DataFrame):
+        nonlocal nb_variants
+        if batch_df.is_empty():
+            return
+        data = batch_df.write_csv(
+            separator="\t", include_header=False, quote_style="never"
+        ).encode("utf-8")
+        if index_builder is not None:
+            # positions of the records in the uncompressed data
+            end_bytes = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord("\n"))
+            end_bytes += fout.position + 1
+            first_bytes = np.concatenate([[fout.position], end_bytes[:-1]])
+            index_builder.add_records(
+                batch_df.select(
+                    pl.col("#CHROM").alias("CHROM"),
+                    (pl.col("POS").cast(pl.Int64) - 1).alias("start"),
+                    (pl.col("POS").cast(pl.Int64) - 1 + pl.col("REF").str.len_bytes()).alias(
+                        "end"
+                    ),
+                    pl.Series("first_byte", first_bytes),
+                    pl.Series("end_byte", end_bytes),
+                )
+            )
+        fout.write(data)
+        nb_variants += batch_df.height
+
+    # batches are handed over as they are produced, so that memory stays bounded
+    # (collect_batches buffers batches when they are consumed slower than they are produced)
+    if other_sinks:
+        pl.collect_all([vcf_lf.sink_batches(write_batch, lazy=True), *other_sinks])
+    else:
+        vcf_lf.sink_batches(write_batch)
+    return nb_variants
+
+
+def write_vcf(
+    vcf_lf: pl.LazyFrame,
+    header_lines: list[str],
+    outfile: Path,
+    index_format: str = "tbi",
+    other_sinks: list[pl.LazyFrame] | None = None,
+) -> int:
+    """
+    Writes variants (raw VCF columns) after the header lines, batch by batch.
+    Files ending in .gz are bgzipped on POLARS_MAX_THREADS threads
+    and indexed in the same pass (<outfile>.tbi or <outfile>.csi);
+    other files are written as plain text.
+    Variants must be sorted for the index to be built.
+    Other lazy sinks are run in the same pass (see write_vcf_records).
+    Returns the number of variants written.
+    """
+    vcf_lf = vcf_lf.rename({"CHROM": "#CHROM"})
+    columns_line = "\t".join(vcf_lf.collect_schema().names()) + "\n"
+    header = "".join(header_lines + [columns_line]).encode("utf-8")
+    if outfile.suffix != ".gz":
+        with open(outfile, "wb") as fout:
+            fout.write(header)
+            return write_vcf_records(vcf_lf, fout, other_sinks=other_sinks)
+
+    index_builder = get_index_builder(header_lines, index_format)
+    with BgzfWriter(outfile, pl.thread_pool_size()) as writer:
+        writer.write(header)
+        nb_variants = write_vcf_records(vcf_lf, writer, index_builder, other_sinks)
+    write_index(index_builder.finish(writer), Path(f"{outfile}.{index_format}"))
+    return nb_variants
+
+
+def write_vcf_part(
+    vcf_lf: pl.LazyFrame, header_lines: list[str], part_file: Path, index_format: str = "tbi"
+) -> tuple[int, Index | None]:
+    """
+    Writes variants without header, as a part of a VCF file put together by merge_vcf_parts.
+    Parts ending in .gz are bgzipped (without EOF block) and indexed.
+    Returns the number of variants written and the index of the part.
+    """
+    vcf_lf = vcf_lf.rename({"CHROM": "#CHROM"})
+    if part_file.suffix != ".gz":
+        with open(part_file, "wb") as fout:
+            return write_vcf_records(vcf_lf, fout), None
+    index_builder = get_index_builder(header_lines, index_format)
+    with BgzfWriter(part_file, pl.thread_pool_size(), eof=False) as writer:
+        nb_variants = write_vcf_records(vcf_lf, writer, index_builder)
+    return nb_variants, index_builder.finish(writer)
+
+
+def merge_vcf_parts(
+    columns: list[str],
+    header_lines: list[str],
+    part_files: list[Path],
+    part_indexes: list[Index | None],
+    outfile: Path,
+    index_format: str = "tbi",
+):
+    """
+    Concatenates parts written by write_vcf_part after the header lines.
+    Bgzipped parts are concatenated as they are, their indexes being shifted accordingly.
+    """
+    columns_line = "\t".join(["#CHROM"] + columns[1:]) + "\n"
+    header = "".join(header_lines + [columns_line]).encode("utf-8")
+    if outfile.suffix != ".gz":
+        with open(outfile, "wb") as fout:
+            fout.write(header)
+            for part_file in part_files:
+                with open(part_file, "rb") as fin:
+                    shutil.copyfileobj(fin, fout)
+        return
+
+    with BgzfWriter(outfile, 1, eof=False) as writer:
+        writer.write(header)
+    index = get_index_builder(header_lines, index_format).index
+    with open(outfile, "ab") as fout:
+        for part_file, part_index in zip(part_files, part_indexes):
+            append_index(index, part_index, fout.tell())
+            with open(part_file, "rb") as fin:
+                shutil.copyfileobj(fin, fout)
+        fout.write(BGZF_EOF)
+    write_index(index, Path(f"{outfile}.{index_format}"))
+
+
+@lru_cache
+def get_format_layouts(
+    vcf_file: Path, regions: tuple[tuple[str, int, int | None], ...] | None = None
+) -> tuple[str, ...]:
+    """
+    Distinct FORMAT layouts (e.g. GT:DP:AD:RO:QR:AO) of the VCF file (or VCF store),
+    in order of first appearance.
+    Resolved with a single streaming pass over the FORMAT column and cached per file.
+    """
+    vcf_lf = parse_vcf_data(vcf_file, list(regions) if regions is not None else None)
+    layouts_df = (
+        vcf_lf.select("FORMAT").unique(maintain_order=True).collect(engine="streaming")
+    )
+    return tuple(layouts_df["FORMAT"].drop_nulls().to_list())
+
+
+def get_field_positions(layouts: tuple[str, ...], field: str) -> dict[int, list[str]]:
+    """
+    Groups FORMAT layouts by position of the field; layouts lacking the field are left out
+    """
+    positions = {}
+    for layout in layouts:
+        keys = layout.split(":")
+        if field in keys:
+            positions.setdefault(keys.index(field), []).append(layout)
+    return positions
+
+
+def get_format_field(
+    split_col: str, positions: dict[int, list[str]], nb_layouts: int
+) -> pl.Expr:
+    """
+    Picks the value of a FORMAT field in a split sample column (see decode_format_fields),
+    at the position given by the FORMAT layout of each row.
+    Rows whose layout lacks the field get a null value.
+    """
+    if not positions:
+        return pl.lit(None, dtype=pl.String)
+    fields = {
+        position: pl.col(split_col).struct.field(f"field_{position}")
+        for position in positions
+    }
+    # when all layouts agree, there is no need to look at FORMAT
+    if len(positions) == 1 and sum(map(len, positions.values())) == nb_layouts:
+        return next(iter(fields.values()))
+    # layouts are disjoint: at most one of the values is not null
+    return pl.coalesce(
+        pl.when(pl.col("FORMAT").is_in(layouts)).then(fields[position])
+        for position, layouts in positions.items()
+    )
+
+
+def decode_field(value: pl.Expr, dtype: pl.DataType) -> pl.Expr:
+    # missing values are encoded as "."
+    value = value.replace(".", None)
+    if dtype == pl.String:
+        return value
+    if isinstance(dtype, pl.List):
+        return value.str.split(",").list.eval(
+            pl.element().replace(".", None).cast(dtype.inner)
+        )
+    return value.cast(dtype)
+
+
+def decode_info_field(key: str, definition: dict | None) -> pl.Expr:
+    dtype = get_field_dtype(definition)
+    if dtype == pl.Boolean:
+        # flags have no value: they are either present or absent
+        return pl.col("INFO").str.contains(rf"(?:^|;){re.escape(key)}(?:;|$)")
+    return decode_field(
+        pl.col("INFO").str.extract(rf"(?:^|;){re.escape(key)}=([^;]*)", 1), dtype
+    )
+
+
+def split_and_decode_format_fields(
+    vcf_lf: pl.LazyFrame,
+    samples: list[str],
+    format_fields: list[str],
+    definitions: dict[str, dict],
+    field_positions: dict[str, dict[int, list[str]]],
+    nb_layouts: int,
+) -> pl.LazyFrame:
+    # each sample column is split only once, whatever the number of fields requested
+    nb_splits = max(
+        (position for positions in field_positions.values() for position in positions),
+        default=0,
+    )
+    split_cols = {sample: f"{sample}__split" for sample in samples}
+    return (
+        vcf_lf.with_columns(
+            pl.col(sample).str.split_exact(":", nb_splits).alias(split_col)
+            for sample, split_col in split_cols.items()
+        )
+        .with_columns(
+            decode_field(
+                get_format_field(split_col, field_positions[field], nb_layouts),
+                get_field_dtype(definitions.get(field)),
+            ).alias(f"{sample}_{field}")
+            for sample, split_col in split_cols.items()
+            for field in format_fields
+        )
+        .drop(split_cols.values())
+    )
+
+
+def decode_format_fields(
+    vcf_lf: pl.LazyFrame,
+    samples: list[str],
+    format_fields: list[str],
+    definitions: dict[str, dict],
+    layouts: tuple[str, ...] | None = None,
+) -> pl.LazyFrame:
+    """
+    Adds one typed column per sample and per FORMAT field, named <sample>_<field>.
+    Fields are looked up in the FORMAT layout of each row, among the layouts of the file
+    (see get_format_layouts) or, if layouts is None, among the layouts of each batch,
+    which saves a pass over the file.
+    """
+    if not format_fields:
+        return vcf_lf
+
+    if layouts is not None:
+        field_positions = {}
+        for field in format_fields:
+            field_positions[field] = get_field_positions(layouts, field)
+            if layouts and not field_positions[field]:
+                raise ValueError(
+                    f"FORMAT field {field} not found in any of the layouts: {layouts}"
+                )
+        return split_and_decode_format_fields(
+            vcf_lf, samples, format_fields, definitions, field_positions, len(layouts)
+        )
+
+    def decode_batch(vcf_df: pl.DataFrame) -> pl.DataFrame:
+        batch_layouts = tuple(vcf_df["FORMAT"].unique(maintain_order=True).drop_nulls())
+        field_positions = {
+            field: get_field_positions(batch_layouts, field) for field in format_fields
+        }
+        return split_and_decode_format_fields(
+            vcf_df.lazy(),
+            samples,
+            format_fields,
+            definitions,
+            field_positions,
+            len(batch_layouts),
+        ).collect()
+
+    schema = vcf_lf.collect_schema()
+    for sample in samples:
+        for field in format_fields:
+            schema[f"{sample}_{field}"] = get_field_dtype(definitions.get(field))
+    # the whole batch is needed to decode it:
+    # projections and filters (possibly on decoded columns) are not pushed through
+    return vcf_lf.map_batches(
+        decode_batch,
+        schema=schema,
+        streamable=True,
+        projection_pushdown=False,
+        predicate_pushdown=False,
+    )
+
+
+def parse_typed_vcf_data(
+    vcf_file: Path,
+    format_fields: list[str],
+    keep_sample_columns: bool = False,
+    info_fields: list[str] | None = None,
+    regions: list[tuple[str, int, int | None]] | None = None,
+) -> pl.LazyFrame:
+    """
+    Parses the VCF file (or VCF store) and decodes the requested FORMAT fields (RO, AO, AD, GT, ...)
+    into one typed column per sample and per field, named <sample>_<field>,
+    and the requested INFO keys into typed columns named INFO_<key>.
+    Dtypes are taken from the ##INFO / ##FORMAT definitions of the header.
+    Raw sample columns are dropped unless keep_sample_columns is True.
+    Fields already decoded in a VCF store are read as is.
+    When regions are given, only variants overlapping them are kept (see parse_vcf_data).
+    """
+    info_fields = info_fields or []
+    header_lines = parse_vcf_header(vcf_file)
+    vcf_columns = parse_vcf_columns(vcf_file)
+    samples = vcf_columns[len(VCF_BASE_COLUMNS):]
+
+    if is_vcf_store(vcf_file):
+        vcf_lf = scan_vcf_store(vcf_file)
+        stored_columns = vcf_lf.collect_schema().names()
+        if regions is not None:
+            contigs = list({contig for contig, _, _ in regions})
+            vcf_lf = vcf_lf.filter(pl.col("CHROM").is_in(contigs)).filter(
+                overlaps_regions(regions)
+            )
+    else:
+        vcf_lf = parse_vcf_data(vcf_file, regions)
+        stored_columns = vcf_columns
+
+    info_definitions = parse_field_definitions(header_lines, "INFO")
+    format_definitions = parse_field_definitions(header_lines, "FORMAT")
+    info_fields_to_decode = [
+        key for key in info_fields if f"{INFO_COLUMN_PREFIX}{key}" not in stored_columns
+    ]
+    vcf_lf = vcf_lf.with_columns(
+        decode_info_field(key, info_definitions.get(key)).alias(
+            f"{INFO_COLUMN_PREFIX}{key}"
+        )
+        for key in info_fields_to_decode
+    )
+
+    format_fields_to_decode = [
+        field
+        for field in format_fields
+        if any(f"{sample}_{field}" not in stored_columns for sample in samples)
+    ]
+    # FORMAT layouts of VCF stores are cheap to resolve for the whole file (FORMAT column only),
+    # those of VCF files are resolved batch by batch so that the file is read only once
+    layouts = None
+    if format_fields_to_decode and is_vcf_store(vcf_file):
+        layouts = get_format_layouts(
+            vcf_file, tuple(regions) if regions is not None else None
+        )
+    for field in format_fields_to_decode:
+        if field not in format_definitions:
+            logger.warning(f"FORMAT field {field} not defined in the header of {vcf_file}")
+    vcf_lf = decode_format_fields(
+        vcf_lf,
+        samples,
+        format_fields_to_decode,
+        format_definitions,
+        layouts,
+    )
+
+    columns = VCF_BASE_COLUMNS.copy()
+    if keep_sample_columns:
+        columns += samples
+    columns += [f"{INFO_COLUMN_PREFIX}{key}" for key in info_fields]
+    columns += [f"{sample}_{field}" for sample in samples for field in format_fields]
+    return vcf_lf.select(columns)
 
 
 def extract_counts(
-    vcf_lf: pl.LazyFrame, sample_cols: list[str], idx: int
+    vcf_lf: pl.LazyFrame, samples: list[str], field: str
+) -> pl.LazyFrame:
+    """
+    Selects the typed <sample>_<field> columns (see parse_typed_vcf_data) as one column per sample.
+    For fields with one value per alternative allele, only the first one is kept.
+    """
+    return vcf_lf.select(get_first_values(vcf_lf.collect_schema(), samples, field).values())
+
+
+def get_first_values(
+    schema: pl.Schema, samples: list[str], field: str
+) -> dict[str, pl.Expr]:
+    """
+    Expressions of the typed <sample>_<field> columns (first value for list fields), by sample
+    """
+    exprs = {}
+    for sample in samples:
+        col = f"{sample}_{field}"
+        expr = pl.col(col)
+        if isinstance(schema[col], pl.List):
+            expr = expr.list.first()
+        exprs[sample] = expr.alias(sample)
+    return exprs
+
+
+def get_genotypes(samples: list[str]) -> dict[str, pl.Expr]:
+    """
+    GT of each sample, taken from the raw sample columns without decoding the other FORMAT fields
+    (GT comes first in FORMAT when present, as required by the VCF specification).
+    Genotypes of rows without GT are null, missing genotypes are kept as ".".
+    """
+    has_genotype = pl.col("FORMAT").str.starts_with("GT:") | (pl.col("FORMAT") == "GT")
+    return {
+        sample: pl.when(has_genotype)
+        .then(pl.col(sample).str.split_exact(":", 0).struct.field("field_0"))
+        .alias(sample)
+        for sample in samples
+    }
+
+
+def get_smallest_unsigned_dtype(max_value: int) -> pl.DataType:
+    for dtype, nb_bits in [(pl.UInt8, 8), (pl.UInt16, 16), (pl.UInt32, 32)]:
+        if max_value < 1 << nb_bits:
+            return dtype
+    return pl.UInt64
+
+
+def to_sparse_counts(counts_lf: pl.LazyFrame, samples: list[str]) -> pl.LazyFrame:
+    """
+    Converts a count matrix (one column per sample) into sparse (variant, sample, count) entries,
+    grouped by variant: one row per variant, holding the list of sample indexes (in samples)
+    and the list of their counts. Zero counts are left out while missing counts are kept as nulls.
+    """
+    sample_dtype = get_smallest_unsigned_dtype(len(samples) - 1)
+
+    def to_sparse_batch(counts_df: pl.DataFrame) -> pl.DataFrame:
+        counts_df = counts_df.with_row_index("variant")
+        # entries are gathered sample by sample, so that samples are sorted within each variant
+        entries_df = pl.concat(
+            counts_df.select(
+                "variant",
+                pl.lit(i, dtype=sample_dtype).alias("sample"),
+                pl.col(sample).cast(COUNT_DTYPE).alias("count"),
+            ).filter(pl.col("count").ne_missing(0))
+            for i, sample in enumerate(samples)
+        )
+        return (
+            counts_df.select("variant")
+            .join(
+                entries_df.group_by("variant").agg("sample", "count"),
+                on="variant",
+                how="left",
+                maintain_order="left",
+            )
+            .drop("variant")
+        )
+
+    # batches keep their number of rows: the variant index is the row index
+    return counts_lf.map_batches(
+        to_sparse_batch,
+        schema={"sample": pl.List(sample_dtype), "count": pl.List(COUNT_DTYPE)},
+        streamable=True,
+        projection_pushdown=False,
+    )
+
+
+def sink_counts(
+    counts_lf: pl.LazyFrame,
+    samples: list[str],
+    outfile: Path,
+    count_layout: str,
+    row_group_size: int | None = None,
+    lazy: bool = False,
+) -> pl.LazyFrame | None:
+    """
+    Writes a count matrix (one column per sample) in one of the COUNT_LAYOUTS:
+    - dense: as is
+    - compact: counts cast to unsigned 32-bit integers
+    - sparse: non-zero entries only (see to_sparse_counts)
+    The layout (and for sparse files, the list of samples) is stored in the Parquet metadata.
+    With lazy=True, the sink is returned to be run later (e.g. with pl.collect_all).
+    """
+    metadata = {COUNT_LAYOUT_METADATA_KEY: count_layout}
+    if count_layout == "dense":
+        metadata = None
+    elif count_layout == "compact":
+        # strict cast: negative or overflowing counts raise instead of wrapping around
+        counts_lf = counts_lf.select(pl.col(samples).cast(COUNT_DTYPE))
+    elif count_layout == "sparse":
+        metadata[COUNT_SAMPLES_METADATA_KEY] = "\t".join(samples)
+        counts_lf = to_sparse_counts(counts_lf, samples)
+    else:
+        raise ValueError(f"Unknown count layout: {count_layout}")
+    return counts_lf.sink_parquet(
+        outfile, metadata=metadata, row_group_size=row_group_size, lazy=lazy
+    )
+
+
+def get_count_layout(count_file: Path) -> str:
+    return pl.read_parquet_metadata(count_file).get(COUNT_LAYOUT_METADATA_KEY, "dense")
+
+
+def get_nb_variants(count_file: Path) -> int:
+    # read from the parquet metadata
+    return pl.scan_parquet(count_file).select(pl.len()).collect().item()
+
+
+def read_counts(
+    count_file: Path,
+    samples: list[str] | None = None,
+    offset: int = 0,
+    length: int | None = None,
+) -> pl.DataFrame:
+    """
+    Reads a slice of a count file written by sink_counts, as one column per sample,
+    whatever its layout. All samples are read if samples is None.
+    """
+    # slices are pushed down to the parquet reader, which only loads the relevant row groups
+    counts_lf = pl.scan_parquet(count_file).slice(offset, length)
+    if get_count_layout(count_file) != "sparse":
+        return counts_lf.collect() if samples is None else counts_lf.select(samples).collect()
+
+    file_samples = pl.read_parquet_metadata(count_file)[COUNT_SAMPLES_METADATA_KEY].split("\t")
+    samples = file_samples if samples is None else samples
+    entries_df = (
+        counts_lf.with_row_index("variant")
+        .explode("sample", "count")
+        .filter(pl.col("sample").is_in([file_samples.index(sample) for sample in samples]))
+        .collect()
+    )
+    # missing counts are marked so that they are not mistaken for absent (zero) entries
+    wide_df = entries_df.with_columns(
+        pl.col("sample").replace_strict(
+            {file_samples.index(sample): sample for sample in samples}, return_dtype=pl.String
+        ),
+        pl.col("count").cast(pl.Int64).fill_null(-1),
+    ).pivot(on="sample", index="variant", values="count")
+    nb_variants = counts_lf.select(pl.len()).collect().item()
+    return (
+        pl.DataFrame({"variant": pl.int_range(nb_variants, dtype=pl.UInt32, eager=True)})
+        .join(wide_df, on="variant", how="left", maintain_order="left")
+        .select(
+            pl.col(sample).fill_null(0).replace(-1, None).cast(COUNT_DTYPE)
+            if sample in wide_df.columns
+            else pl.repeat(0, nb_variants, dtype=COUNT_DTYPE, eager=True).alias(sample)
+            for sample in samples
+        )
+    )
+
+
+def add_pvalues(vcf_lf: pl.LazyFrame, pvalues_lf: pl.LazyFrame) -> pl.LazyFrame:
+    """
+    Pairs variants with p-values (one per line, in the same order) as a "pvalue" column.
+    Both inputs are read in the same streaming pass, and a ValueError is raised
+    as soon as one of them runs out before the other, instead of counting them beforehand.
+    """
+    variant_marker, pvalue_marker = "__variant", "__pvalue"
+    schema = pl.Schema({**vcf_lf.collect_schema(), **pvalues_lf.collect_schema()})
+    nb_rows = 0
+
+    def check_batch(df: pl.DataFrame) -> pl.DataFrame:
+        nonlocal nb_rows
+        nb_rows += len(df)
+        # the shorter input is padded with nulls by the horizontal concatenation
+        nb_missing_variants = df[variant_marker].null_count()
+        nb_missing_pvalues = df[pvalue_marker].null_count()
+        if nb_missing_variants or nb_missing_pvalues:
+            raise ValueError(
+                "Number of variants and number of pvalues do not match: "
+                f"{nb_rows - nb_missing_variants} variants and "
+                f"{nb_rows - nb_missing_pvalues} pvalues after {nb_rows} rows."
+            )
+        return df.drop(variant_marker, pvalue_marker)
+
+    return pl.concat(
+        [
+            vcf_lf.with_columns(pl.lit(True).alias(variant_marker)),
+            pvalues_lf.with_columns(pl.lit(True).alias(pvalue_marker)),
+        ],
+        how="horizontal",
+    ).map_batches(
+        check_batch,
+        schema=schema,
+        streamable=True,
+        projection_pushdown=False,
+        predicate_pushdown=False,
+    )
+
+
+def scan_pvalues(pvalue_file: Path) -> pl.LazyFrame:
+    """
+    Scans a p-value file written by the statistical tests:
+    either a parquet file keyed by variant index (PVALUE_KEY_COLUMN, pvalue),
+    or a text file with one p-value per line, in the order of the variants.
+    """
+    if pvalue_file.suffix == ".parquet":
+        return pl.scan_parquet(pvalue_file)
+    return pl.scan_csv(
+        pvalue_file, has_header=False, new_columns=["pvalue"], null_values=["NA"]
+    )
+
+
+def join_pvalues(
+    vcf_lf: pl.LazyFrame,
+    pvalues_lf: pl.LazyFrame,
+    regions: list[tuple[str, int, int | None]] | None = None,
 ) -> pl.LazyFrame:
-    return vcf_lf.select(
-        pl.col(sample_cols).str.split(":").list[idx].replace(".", None).cast(pl.Int64)
+    """
+    Adds a "pvalue" column to the variants.
+    Keyed p-values are joined on the variant index, so that they can be in any order.
+    Keys must be unique and match the variants one to one: a ValueError is raised
+    as soon as a variant without a p-value or a p-value without a variant is streamed.
+    Since keys index all the variants of the VCF file, keyed p-values cannot be joined
+    with variants restricted to regions.
+    P-values without a key are paired by position (see add_pvalues).
+    """
+    if PVALUE_KEY_COLUMN not in pvalues_lf.collect_schema():
+        return add_pvalues(vcf_lf, pvalues_lf)
+    if regions is not None:
+        raise ValueError(
+            "P-values keyed by variant index cannot be used with --region / --regions-file: "
+            "keys index the variants of the whole VCF file"
+        )
+    variant_marker, pvalue_marker = "__variant", "__pvalue"
+    schema = pl.Schema(
+        {**vcf_lf.collect_schema(), "pvalue": pvalues_lf.collect_schema()["pvalue"]}
+    )
+
+    def check_batch(df: pl.DataFrame) -> pl.DataFrame:
+        # the full join pads variants without a p-value and p-values without a variant with nulls
+        nb_missing_variants = df[variant_marker].null_count()
+        nb_missing_pvalues = df[pvalue_marker].null_count()
+        if nb_missing_variants or nb_missing_pvalues:
+            raise ValueError(
+                "Variant indexes of the p-values do not match the variants: "
+                f"{nb_missing_pvalues} variants without a p-value and "
+                f"{nb_missing_variants} p-values without a variant."
+            )
+        return df.drop(PVALUE_KEY_COLUMN, variant_marker, pvalue_marker)
+
+    # both sides hold one row per variant (the p-value table is as large as the variant stream);
+    # variants keep their order whatever the order of the keys
+    return (
+        vcf_lf.with_row_index(PVALUE_KEY_COLUMN)
+        .with_columns(pl.lit(True).alias(variant_marker))
+        .join(
+            pvalues_lf.select(
+                pl.col(PVALUE_KEY_COLUMN).cast(pl.get_index_type()),
+                "pvalue",
+                pl.lit(True).alias(pvalue_marker),
+            ),
+            on=PVALUE_KEY_COLUMN,
+            how="full",
+            coalesce=True,
+            maintain_order="left_right",
+            validate="1:1",
+        )
+        .map_batches(
+            check_batch,
+            schema=schema,
+            streamable=True,
+            projection_pushdown=False,
+            predicate_pushdown=False,
+        )
     )
+
+
+def get_sketch_gamma(relative_error: float) -> float:
+    if not 0 < relative_error < 1:
+        raise ValueError(f"Relative error of quantile sketches must be in (0, 1): {relative_error}")
+    return (1 + relative_error) / (1 - relative_error)
+
+
+def build_quantile_sketches(
+    lf: pl.LazyFrame, by: list[str], value: str, relative_error: float
+) -> pl.LazyFrame:
+    """
+    Summarises the values of each group (positive values, such as p-values) into a quantile sketch
+    (as in DDSketch): values are counted in logarithmic buckets, bucket i holding the values
+    in (gamma^(i-1), gamma^i], values below SKETCH_MIN_VALUE being counted with it.
+    Memory depends on the number of buckets per group, not on the number of values.
+    Sketches are (by..., bucket, count) rows: sketches of the same group computed on different
+    chunks or contigs are merged by adding up the counts of their buckets (see get_sketch_quantiles).
+    """
+    gamma = get_sketch_gamma(relative_error)
+    return (
+        lf.filter(pl.col(value).is_not_null() & pl.col(value).is_not_nan())
+        .with_columns(
+            pl.col(value)
+            .clip(lower_bound=SKETCH_MIN_VALUE)
+            .log(gamma)
+            .ceil()
+            .cast(pl.Int32)
+            .alias(SKETCH_BUCKET_COLUMN)
+        )
+        .group_by(by + [SKETCH_BUCKET_COLUMN])
+        .agg(pl.len().alias(SKETCH_COUNT_COLUMN))
+    )
+
+
+def get_sketch_quantiles(
+    sketches_lf: pl.LazyFrame,
+    by: list[str],
+    quantiles: dict[str, float],
+    relative_error: float,
+) -> pl.LazyFrame:
+    """
+    Estimates quantiles (output column name -> quantile) from the sketches of each group.
+    The value of rank round(q * (n - 1)) is looked up, as pl.Expr.quantile does,
+    and estimated within relative_error of its actual value.
+    """
+    gamma = get_sketch_gamma(relative_error)
+    count = pl.col(SKETCH_COUNT_COLUMN)
+    ranks = {
+        name: (quantile * (count.sum() - 1) + 0.5).floor()
+        for name, quantile in quantiles.items()
+    }
+    # buckets are sorted within each group rather than sorting all the sketches
+    sorted_buckets = pl.col(SKETCH_BUCKET_COLUMN).sort()
+    sorted_counts = count.sort_by(SKETCH_BUCKET_COLUMN)
+    return (
+        sketches_lf.group_by(by + [SKETCH_BUCKET_COLUMN])
+        .agg(count.sum())
+        .group_by(by)
+        .agg(
+            # first bucket holding more values than the rank
+            sorted_buckets.get((sorted_counts.cum_sum() > rank).arg_max()).alias(name)
+            for name, rank in ranks.items()
+        )
+        .with_columns(
+            # middle of the bucket (in relative terms)
+            (2 * pl.lit(gamma).pow(pl.col(name)) / (gamma + 1)).alias(name)
+            for name in quantiles
+        )
+    )
+
+
+def get_allele_counts(phenotype_to_samples: dict[str, list[str]]) -> pl.Expr:
+    """
+    Gathers the allele depths (AD) of samples as an "allele_counts" struct column,
+    with one field per sample (grouped by phenotype) holding its counts of each allele (REF, ALT, ...).
+    Hover texts are rendered from it by the Dash app, only for displayed variants.
+    """
+    return pl.struct(
+        pl.col(f"{sample}_AD").cast(pl.List(COUNT_DTYPE)).alias(sample)
+        for samples in phenotype_to_samples.values()
+        for sample in samples
+    ).alias("allele_counts")
@@ -1,25 +1,51 @@
+#!/usr/bin/env python3
+
+# Written by Olivier Coen. Released under the MIT license.
+
 import argparse
 import logging
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 from pathlib import Path
-import polars as pl
 
-from scipy.stats import fisher_exact
 import numpy as np
-from scipy.stats import MonteCarloMethod
-
-from common import parse_vcf_data
+import polars as pl
+from common import PVALUE_KEY_COLUMN, get_nb_variants, read_counts
+from scipy.special import gammaln
+from scipy.stats import MonteCarloMethod, chi2, fisher_exact
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+ALLOWED_METHODS = ["cmh", "fet", "chisq"]
+
+CHUNK_SIZE = 100000
+
+NB_MONTE_CARLO_SIMULATIONS = 10000
+# same relative tolerance as R's fisher.test when comparing table probabilities
+FET_RELATIVE_ERROR = 1 + 1e-7
+# maximum number of cells (tables x possible values of the first cell)
+# evaluated at once when computing exact hypergeometric probabilities
+FET_MAX_CELLS_PER_BLOCK = int(2e7)
+
 #####################################################
 #####################################################
 # FUNCTIONS
 #####################################################
 #####################################################
 
+
 def parse_args():
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(description="Compute stat test")
+    parser.add_argument(
+        "--method",
+        choices=ALLOWED_METHODS,
+        required=True,
+        help="Method to use",
+    )
     parser.add_argument(
         "--RO",
         type=Path,
@@ -32,7 +58,7 @@ def parse_args():
         type=Path,
         dest="AO_file",
         required=True,
-        help="Path to file containing reference counts",
+        help="Path to file containing alternative counts",
     )
     parser.add_argument(
         "--design",
@@ -41,18 +67,362 @@ def parse_args():
         required=True,
         help="Path to design file",
     )
+    parser.add_argument(
+        "--out",
+        type=Path,
+        dest="outfile",
+        required=True,
+        help="Path to output file",
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Compute the test only once per unique contingency table",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=CHUNK_SIZE,
+        help="Number of variants loaded and tested at once",
+    )
+    parser.add_argument(
+        "--cpus",
+        type=int,
+        default=1,
+        help="Number of processes testing chunks in parallel",
+    )
     return parser.parse_args()
 
 
-def get_position_in_format(vcf_lf: pl.LazyFrame, info: str) -> int:
-    fmt_series = vcf_lf.select("FORMAT").collect().to_series()
-    if fmt_series.unique().len() > 1:
-        raise ValueError(f"More than one format found: {fmt_series.unique()}")
-    fmt = fmt_series.unique().item()
-    return fmt.split(":").index(info)
+def get_sample_lists(design_df: pl.DataFrame) -> list[list[str]]:
+    """
+    Groups samples by phenotype (phenotypes sorted alphabetically),
+    samples being sorted by population within each phenotype.
+    Mirrors get_sample_lists() in compute_statistical_test.R so that strata are paired identically.
+    """
+    return (
+        design_df.select(["sample", "population", "phenotype"])
+        .unique()
+        .sort(["phenotype", "population"])
+        .group_by("phenotype", maintain_order=True)
+        .agg("sample")
+        .get_column("sample")
+        .to_list()
+    )
+
+
+def parse_counts(
+    count_file: Path, samples: list[str], offset: int = 0, length: int | None = None
+) -> np.ndarray:
+    # missing counts are stored as NaN so that they can be ignored when summing
+    return (
+        read_counts(count_file, samples, offset, length)
+        .cast(pl.Float64)
+        .fill_null(np.nan)
+        .to_numpy()
+    )
+
+
+def build_contingency_tables(
+    RO: np.ndarray, AO: np.ndarray, sample_lists: list[list[int]]
+) -> np.ndarray:
+    """
+    Builds all contingency tables at once, as an array of shape [n_snp x 2 x n_phenotypes]:
+                   pheno 1      pheno 2    ...
+    ref allele     sum(RO_1)    sum(RO_2)
+    alt allele     sum(AO_1)    sum(AO_2)
+    """
+    tables = np.empty((RO.shape[0], 2, len(sample_lists)), dtype=np.float64)
+    for pheno, sample_idx in enumerate(sample_lists):
+        tables[:, 0, pheno] = np.nansum(RO[:, sample_idx], axis=1)
+        tables[:, 1, pheno] = np.nansum(AO[:, sample_idx], axis=1)
+    return tables
+
+
+def log_choose(n: np.ndarray, k: np.ndarray) -> np.ndarray:
+    return gammaln(n + 1) - gammaln(k + 1) - gammaln(n - k + 1)
+
+
+def compute_fet_2x2(tables: np.ndarray) -> np.ndarray:
+    """
+    Two-sided Fisher's exact test on 2x2 tables, computed the same way as R's fisher.test:
+    the p-value is the sum of the probabilities of all tables (with the same margins)
+    that are not more likely than the observed one.
+    Tables are processed by blocks of similar support size so that the grid of hypergeometric probabilities fits in memory.
+    """
+    tables = tables.astype(np.int64)
+    x = tables[:, 0, 0]
+    m = tables[:, 0, :].sum(axis=1)  # ref allele total
+    n = tables[:, 1, :].sum(axis=1)  # alt allele total
+    k = tables[:, :, 0].sum(axis=1)  # phenotype 1 total
+
+    lo = np.maximum(0, k - n)
+    hi = np.minimum(k, m)
+    support_sizes = hi - lo + 1
+    log_denominator = log_choose(m + n, k)
+    log_observed = log_choose(m, x) + log_choose(n, k - x) - log_denominator
+
+    p_values = np.empty(len(tables), dtype=np.float64)
+    order = np.argsort(support_sizes, kind="stable")
+    sorted_support_sizes = support_sizes[order]
+    start = 0
+    while start < len(order):
+        # largest block such that (nb of tables x largest support) stays under the budget
+        stop = len(order)
+        while (
+            stop - start > 1
+            and (stop - start) * sorted_support_sizes[stop - 1] > FET_MAX_CELLS_PER_BLOCK
+        ):
+            stop = start + (stop - start) // 2
+        idx = order[start:stop]
+
+        width = int(support_sizes[idx].max())
+        grid = lo[idx, None] + np.arange(width)[None, :]
+        valid = grid <= hi[idx, None]
+        grid = np.where(valid, grid, lo[idx, None])
+        log_probs = (
+            log_choose(m[idx, None], grid)
+            + log_choose(n[idx, None], k[idx, None] - grid)
+            - log_denominator[idx, None]
+        )
+        is_extreme = valid & (
+            log_probs <= log_observed[idx, None] + np.log(FET_RELATIVE_ERROR)
+        )
+        p_values[idx] = np.where(is_extreme, np.exp(log_probs), 0).sum(axis=1)
+        start = stop
+
+    return np.minimum(p_values, 1)
+
+
+def compute_fet_2xk(tables: np.ndarray) -> np.ndarray:
+    # there is no closed form for more than two phenotypes: using Monte Carlo simulations, as in R
+    logger.info(
+        "More than two phenotypes: falling back to per-SNP Monte Carlo Fisher's exact test"
+    )
+    rng = np.random.default_rng(seed=42)
+    method = MonteCarloMethod(n_resamples=NB_MONTE_CARLO_SIMULATIONS, rng=rng)
+    p_values = np.full(len(tables), np.nan)
+    for i, table in enumerate(tables):
+        try:
+            p_values[i] = fisher_exact(table, method=method).pvalue
+        except ValueError:
+            pass
+    return p_values
+
+
+def compute_fet(tables: np.ndarray) -> np.ndarray:
+    if tables.shape[2] == 2:
+        return compute_fet_2x2(tables)
+    return compute_fet_2xk(tables)
 
 
-fisher_exact([[8, 2, 3], [1, 5, 4]], method=method)
+def compute_chisq(tables: np.ndarray) -> np.ndarray:
+    """
+    Pearson's chi-square test, applying Yates' continuity correction on 2x2 tables (as R's chisq.test)
+    """
+    n = tables.sum(axis=(1, 2))
+    row_sums = tables.sum(axis=2)
+    col_sums = tables.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        expected = row_sums[:, :, None] * col_sums[:, None, :] / n[:, None, None]
+        delta = np.abs(tables - expected)
+        if tables.shape[2] == 2:
+            delta -= np.minimum(0.5, delta)
+        stat = (delta**2 / expected).sum(axis=(1, 2))
+    dof = tables.shape[2] - 1
+    return chi2.sf(stat, dof)
+
+
+def compute_cmh(
+    RO: np.ndarray, AO: np.ndarray, sample_lists: list[list[int]], correct: bool = True
+) -> np.ndarray:
+    """
+    Vectorised Cochran-Mantel-Haenszel test (see compute_cochran_mantel_haenszel_test() in compute_statistical_test.R),
+    each stratum being made of the i-th sample of phenotype 1 and the i-th sample of phenotype 2.
+    """
+    if len(sample_lists) != 2:
+        raise ValueError("Exactly two phenotypes needed for the CMH test")
+    samples_pheno_1, samples_pheno_2 = sample_lists
+    if len(samples_pheno_1) != len(samples_pheno_2):
+        raise ValueError(
+            "Number of samples in phenotype 1 does not match number of samples in phenotype 2"
+        )
+    R0, R1 = RO[:, samples_pheno_1], RO[:, samples_pheno_2]
+    A0, A1 = AO[:, samples_pheno_1], AO[:, samples_pheno_2]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        n = R0 + R1 + A0 + A1
+        row_sum1 = R0 + R1
+        row_sum2 = A0 + A1
+        col_sum1 = R0 + A0
+        col_sum2 = R1 + A1
+
+        expected = (row_sum1 * col_sum1) / n
+        V = (row_sum1 * row_sum2 * col_sum1 * col_sum2) / (n**2 * (n - 1))
+
+        delta = np.abs(np.nansum(R0 - expected, axis=1))
+        yates = np.minimum(delta, 0.5) if correct else 0
+
+        stat = (delta - yates) ** 2 / np.nansum(V, axis=1)
+
+    p_values = chi2.sf(stat, 1)
+    p_values[~np.isfinite(p_values)] = np.nan
+    return p_values
+
+
+def adjust_pvalues(p_values: np.ndarray) -> np.ndarray:
+    """
+    Benjamini-Hochberg correction ignoring missing values, as R's p.adjust(method = "fdr")
+    """
+    adjusted = np.full(len(p_values), np.nan)
+    is_valid = ~np.isnan(p_values)
+    valid_p_values = p_values[is_valid]
+    nb_valid = len(valid_p_values)
+    if nb_valid == 0:
+        return adjusted
+    order = np.argsort(valid_p_values)[::-1]
+    ranks = np.arange(nb_valid, 0, -1)
+    cummin = np.minimum.accumulate(nb_valid / ranks * valid_p_values[order])
+    valid_adjusted = np.empty(nb_valid)
+    valid_adjusted[order] = np.minimum(1, cummin)
+    adjusted[is_valid] = valid_adjusted
+    return adjusted
+
+
+def get_unique_tables(tables: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Hashes each table (as the raw bytes of its cells) and returns the unique tables,
+    along with the index of the unique table corresponding to each SNP.
+    """
+    # missing counts are replaced by a sentinel so that NaN cells compare equal
+    flat_tables = np.ascontiguousarray(
+        np.nan_to_num(tables, nan=-1).reshape(len(tables), -1)
+    )
+    row_view = flat_tables.view(
+        np.dtype((np.void, flat_tables.dtype.itemsize * flat_tables.shape[1]))
+    ).ravel()
+    _, first_occurrences, inverse = np.unique(
+        row_view, return_index=True, return_inverse=True
+    )
+    return tables[first_occurrences], inverse.ravel()
+
+
+def compute_pooled_test(method: str, tables: np.ndarray) -> np.ndarray:
+    # tables with no count at all cannot be tested
+    is_empty = tables.sum(axis=(1, 2)) == 0
+    if method == "fet":
+        p_values = compute_fet(tables)
+    elif method == "chisq":
+        p_values = compute_chisq(tables)
+    else:
+        raise ValueError(f"Method not recognised: {method}")
+    p_values[is_empty] = np.nan
+    return p_values
+
+
+def compute_test_on_tables(
+    method: str, tables: np.ndarray, sample_lists: list[list[int]]
+) -> np.ndarray:
+    if method == "cmh":
+        return compute_cmh(tables[:, 0], tables[:, 1], sample_lists)
+    return compute_pooled_test(method, tables)
+
+
+def compute_test(
+    method: str,
+    RO: np.ndarray,
+    AO: np.ndarray,
+    sample_lists: list[list[int]],
+    dedup: bool = False,
+) -> tuple[np.ndarray, int]:
+    """
+    Returns the p-values of the SNPs and the number of contingency tables actually tested
+    """
+    if method == "cmh":
+        # the CMH test works on the per-population tables [n_snp x 2 x n_samples]
+        tables = np.stack([RO, AO], axis=1)
+    else:
+        tables = build_contingency_tables(RO, AO, sample_lists)
+
+    if not dedup:
+        return compute_test_on_tables(method, tables, sample_lists), len(tables)
+
+    unique_tables, inverse = get_unique_tables(tables)
+    # each unique table is tested once and its p-value is broadcast back to all SNPs sharing it
+    return (
+        compute_test_on_tables(method, unique_tables, sample_lists)[inverse],
+        len(unique_tables),
+    )
+
+
+def compute_chunk(
+    method: str,
+    RO_file: Path,
+    AO_file: Path,
+    samples: list[str],
+    sample_lists: list[list[int]],
+    dedup: bool,
+    offset: int,
+    length: int,
+) -> tuple[np.ndarray, int]:
+    RO = parse_counts(RO_file, samples, offset, length)
+    AO = parse_counts(AO_file, samples, offset, length)
+    return compute_test(method, RO, AO, sample_lists, dedup=dedup)
+
+
+def iter_chunk_pvalues(chunks: list[tuple[int, int]], nb_workers: int, **kwargs):
+    """
+    Yields (offset, (p-values, number of tables tested)) for each chunk, in the order of the chunks.
+    Workers read their own slice of the count files so that only p-values are sent back,
+    and at most 2 chunks per worker are in flight at any time to keep memory bounded.
+    """
+    if nb_workers <= 1:
+        for offset, length in chunks:
+            yield offset, compute_chunk(offset=offset, length=length, **kwargs)
+        return
+
+    # avoiding oversubscription: each worker gets a single Polars thread
+    os.environ["POLARS_MAX_THREADS"] = "1"
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=nb_workers, mp_context=context) as executor:
+        chunk_iterator = iter(chunks)
+        pending = deque(
+            (offset, executor.submit(compute_chunk, offset=offset, length=length, **kwargs))
+            for offset, length in islice(chunk_iterator, 2 * nb_workers)
+        )
+        while pending:
+            offset, future = pending.popleft()
+            result = future.result()
+            next_chunk = next(chunk_iterator, None)
+            if next_chunk is not None:
+                next_offset, next_length = next_chunk
+                future = executor.submit(
+                    compute_chunk, offset=next_offset, length=next_length, **kwargs
+                )
+                pending.append((next_offset, future))
+            yield offset, result
+
+
+def write_pvalues(p_values: np.ndarray, outfile: Path):
+    """
+    Writes p-values as a parquet file keyed by variant index (see scan_pvalues in common.py),
+    or as text (one p-value per line) for other file extensions
+    """
+    if outfile.suffix == ".parquet":
+        pl.DataFrame(
+            {
+                PVALUE_KEY_COLUMN: pl.int_range(len(p_values), dtype=pl.UInt64, eager=True),
+                "pvalue": p_values,
+            }
+        ).with_columns(pl.col("pvalue").fill_nan(None)).write_parquet(outfile)
+        return
+    with open(outfile, "w") as fout:
+        for start in range(0, len(p_values), CHUNK_SIZE):
+            fout.writelines(
+                "NA\n" if np.isnan(p) else f"{p:.15g}\n"
+                for p in p_values[start : start + CHUNK_SIZE].tolist()
+            )
+
 
 #####################################################
 #####################################################
@@ -60,19 +430,77 @@ fisher_exact([[8, 2, 3], [1, 5, 4]], method=method)
 #####################################################
 #####################################################
 
+
 def main():
     args = parse_args()
-    
-    logger.info("Parsing allele counts")
-    RO_lf = pl.scan_parquet(args.RO_file).select(pl.all().name.suffix("_RO"))
-    AO_lf = pl.scan_parquet(args.AO_file).select(pl.all().name.suffix("_AO"))
-
-    RO_cols = RO_lf.collect_schema().names()
-    AO_cols = AO_lf.collect_schema().names()
-    
+
     design_df = pl.read_csv(args.design_file)
-    
-    rng = np.random.default_rng(seed=42)
-    method = MonteCarloMethod(rng=rng)
-    
-    
\ No newline at end of file
+    sample_lists = get_sample_lists(design_df)
+    for i, samples in enumerate(sample_lists, start=1):
+        logger.info(f"Samples for phenotype {i}: {', '.join(samples)}")
+
+    # columns of the count matrices follow the flattened sample lists
+    samples = [sample for samples in sample_lists for sample in samples]
+    sample_idx_lists = []
+    start = 0
+    for samples_pheno in sample_lists:
+        sample_idx_lists.append(list(range(start, start + len(samples_pheno))))
+        start += len(samples_pheno)
+
+    nb_rows = get_nb_variants(args.RO_file)
+    if nb_rows != get_nb_variants(args.AO_file):
+        raise ValueError("RO and AO datasets have different number of rows.")
+    logger.info(f"RO dataset has {nb_rows} rows.")
+
+    chunks = [
+        (offset, min(args.chunksize, nb_rows - offset))
+        for offset in range(0, nb_rows, args.chunksize)
+    ]
+    logger.info(
+        f"Computing {args.method} p-values on {len(chunks)} chunks with {args.cpus} processes"
+    )
+    # only the p-values are kept for the whole genome (8 bytes per variant),
+    # since the FDR correction needs all of them
+    p_values = np.empty(nb_rows, dtype=np.float64)
+    total_processed_rows = 0
+    nb_tested_tables = 0
+    for i, (offset, (chunk_p_values, nb_chunk_tables)) in enumerate(
+        iter_chunk_pvalues(
+            chunks,
+            args.cpus,
+            method=args.method,
+            RO_file=args.RO_file,
+            AO_file=args.AO_file,
+            samples=samples,
+            sample_lists=sample_idx_lists,
+            dedup=args.dedup,
+        ),
+        start=1,
+    ):
+        p_values[offset : offset + len(chunk_p_values)] = chunk_p_values
+        total_processed_rows += len(chunk_p_values)
+        nb_tested_tables += nb_chunk_tables
+        logger.info(
+            f"Chunk {i} done. {total_processed_rows} rows processed "
+            f"({total_processed_rows / nb_rows:.2%} of total)."
+        )
+
+    if args.dedup:
+        # tables are deduplicated within each chunk: tables shared by several chunks
+        # are counted once per chunk, so the number of distinct tables may be lower
+        hit_ratio = 1 - nb_tested_tables / nb_rows if nb_rows > 0 else 0
+        chunk_note = ", tables being deduplicated within each chunk" if len(chunks) > 1 else ""
+        logger.info(
+            f"{nb_tested_tables} unique contingency tables out of {nb_rows} "
+            f"(hit ratio: {hit_ratio:.2%}{chunk_note})"
+        )
+
+    logger.info("Adjusting p-values")
+    p_values = adjust_pvalues(p_values)
+
+    logger.info(f"Writing p-values to {args.outfile}")
+    write_pvalues(p_values, args.outfile)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,13 @@ import logging
 from pathlib import Path
 
 import polars as pl
-from tqdm import tqdm
-from common import parse_vcf_data
+from common import (
+    CONTIG_AXIS_SPACING,
+    add_region_arguments,
+    get_regions,
+    parse_vcf_data,
+    partition_by_contig,
+)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -25,7 +30,7 @@ def parse_args():
         type=Path,
         dest="vcf_file",
         required=True,
-        help="Path to VCF file",
+        help="Path to VCF file (or VCF store)",
     )
     parser.add_argument(
         "--window-size",
@@ -41,8 +46,69 @@ def parse_args():
         required=True,
         help="Path to output file",
     )
+    add_region_arguments(parser)
     return parser.parse_args()
 
+def get_snp_positions(vcf_lf: pl.LazyFrame) -> pl.DataFrame:
+    """
+    Collects SNP positions in a single pass over the VCF,
+    sorted by position within contigs (contigs are kept in order of first appearance)
+    """
+    positions_df = vcf_lf.select("CHROM", "POS").collect(engine="streaming")
+    contig_dfs = partition_by_contig(positions_df)
+    return pl.concat(
+        [positions_df.clear()]
+        + [contig_df.sort("POS", maintain_order=True) for contig_df in contig_dfs.values()]
+    ).select(pl.col("CHROM").rle_id().alias("contig_rank"), "CHROM", "POS")
+
+
+def compute_density_scores(positions_df: pl.DataFrame, window_size: int) -> pl.Series:
+    """
+    Scores each SNP by 1 - 300 * density, where density is the mean number of SNPs per base
+    in a window centred on the SNP (rolling mean of SNP counts over all bases of the contig).
+    Only SNP positions are used: the bases of the contig are laid out as rows,
+    bases holding several SNPs taking one row per SNP,
+    and the SNPs of each window are counted by binary search on the rows of SNPs.
+    Contigs are laid on a single axis so that all windows are searched at once.
+    """
+    # same window as rolling_mean(window_size, center=True)
+    nb_rows_before = window_size // 2
+    nb_rows_after = window_size - 1 - nb_rows_before
+    pos = pl.col("POS")
+    rows_df = positions_df.select(
+        pl.col("contig_rank").cast(pl.Int64) * CONTIG_AXIS_SPACING,
+        # bases before the SNP, plus extra rows of bases holding several SNPs
+        (
+            pos - 1
+            + pl.int_range(pl.len()).over("CHROM")
+            - (pos.rank("dense").over("CHROM") - 1)
+        ).alias("row"),
+        (pos.max() + pl.len() - pos.n_unique()).over("CHROM").alias("nb_rows"),
+    ).select(
+        (pl.col("contig_rank") + pl.col("row")).alias("axis"),
+        (pl.col("contig_rank") + (pl.col("row") - nb_rows_before).clip(lower_bound=0)).alias(
+            "window_start"
+        ),
+        (
+            pl.col("contig_rank")
+            + pl.min_horizontal(pl.col("row") + nb_rows_after, pl.col("nb_rows") - 1)
+        ).alias("window_end"),
+    )
+    axis = pl.col("axis")
+    return rows_df.select(
+        pl.max_horizontal(
+            1
+            - 300
+            * (
+                axis.search_sorted(pl.col("window_end"), side="right")
+                - axis.search_sorted(pl.col("window_start"), side="left")
+            )
+            / (pl.col("window_end") - pl.col("window_start") + 1),
+            1e-10,
+        ).alias("score")
+    ).to_series()
+
+
 #####################################################
 #####################################################
 # MAIN
@@ -52,56 +118,17 @@ def parse_args():
 
 def main():
     args = parse_args()
+    regions = get_regions(args)
 
     logger.info("Parsing VCF file")
 
-    vcf_lf = parse_vcf_data(args.vcf_file)
+    vcf_lf = parse_vcf_data(args.vcf_file, regions)
+    positions_df = get_snp_positions(vcf_lf)
 
-    contigs = (
-        vcf_lf.select("CHROM")
-        .collect()
-        .unique(maintain_order=True)
-        .to_series().to_list()
-    )
+    logger.info(f"Computing SNP density for {positions_df['CHROM'].n_unique()} contigs")
+    scores = compute_density_scores(positions_df, args.window_size)
 
-    logger.info(f"Computing SNP density for {len(contigs)} contigs")
-    for contig in tqdm(contigs):
-        contig_lf = vcf_lf.filter(pl.col("CHROM") == contig)
-        max_position = contig_lf.select("POS").collect().max().item()
-        positions = list(range(1, max_position + 1))
-        
-        all_positions_df = pl.DataFrame({"position": positions})
-        snp_positions_df = contig_lf.with_columns(pl.lit(1).alias("count")).select(
-            pl.col("POS").alias("position"), 
-            pl.col("count")
-        ).collect()
-    
-        #weights = [2 * (1 + i) / args.window_size for i in range(args.window_size // 2)]
-        #weights = weights + list(reversed(weights))
-        
-        scores = (
-            all_positions_df
-                .join(snp_positions_df, on="position", how="left")
-                .with_columns(pl.col("count").alias("original_count"))
-                .with_columns(pl.col("count").fill_null(0))
-                .with_columns(
-                    pl.col("count").rolling_mean(
-                        window_size=args.window_size, 
-                        min_samples=1, 
-                        center=True, 
-                        #weights=weights
-                    ).alias("density")
-                )
-                .filter(pl.col("original_count").is_not_null())
-                .select((1 - 300 * pl.col("density")).alias("score"))
-                #.drop_nulls()
-                .to_series().to_list()
-        )
-
-        scores = [max(1e-10, score) for score in scores]
-
-        with open(args.outfile, 'a') as fout:
-            fout.writelines([f'{score:.10f}\n' for score in scores])
+    scores.to_frame().write_csv(args.outfile, include_header=False, float_precision=10)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import shutil
+from pathlib import Path
+
+import polars as pl
+from common import (
+    VCF_STORE_HEADER_FILE,
+    add_region_arguments,
+    get_regions,
+    is_vcf_store,
+    parse_field_definitions,
+    parse_typed_vcf_data,
+    parse_vcf_columns,
+    parse_vcf_header,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MAX_ROWS_PER_FILE = int(1e6)
+
+#####################################################
+#####################################################
+# FUNCTIONS
+#####################################################
+#####################################################
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Convert a VCF file to a VCF store (partitioned parquet dataset)"
+    )
+    parser.add_argument(
+        "--vcf",
+        type=Path,
+        dest="vcf_file",
+        required=True,
+        help="Path to VCF file",
+    )
+    parser.add_argument(
+        "--out",
+        type=Path,
+        dest="outdir",
+        required=True,
+        help="Path to output VCF store (directory)",
+    )
+    parser.add_argument(
+        "--max-rows-per-file",
+        dest="max_rows_per_file",
+        type=int,
+        default=MAX_ROWS_PER_FILE,
+        help="Maximum number of variants per parquet file",
+    )
+    add_region_arguments(parser)
+    return parser.parse_args()
+
+
+def prepare_outdir(vcf_file: Path, outdir: Path):
+    """
+    Creates the output directory. A store already there is removed, since every part
+    of the directory is read back as data; other non-empty directories are refused.
+    """
+    if outdir.exists() and vcf_file.exists() and outdir.samefile(vcf_file):
+        raise ValueError(f"Cannot convert VCF store {vcf_file} into itself")
+    if is_vcf_store(outdir):
+        logger.info(f"Removing existing VCF store {outdir}")
+        shutil.rmtree(outdir)
+    elif outdir.is_dir() and any(outdir.iterdir()):
+        raise ValueError(f"Output directory {outdir} is not empty and is not a VCF store")
+    outdir.mkdir(parents=True, exist_ok=True)
+
+
+def write_header(vcf_file: Path, outdir: Path):
+    header_lines = parse_vcf_header(vcf_file)
+    columns = parse_vcf_columns(vcf_file)
+    with open(outdir / VCF_STORE_HEADER_FILE, "w") as fout:
+        fout.writelines(header_lines)
+        fout.write("\t".join(["#CHROM"] + columns[1:]) + "\n")
+
+
+#####################################################
+#####################################################
+# MAIN
+#####################################################
+#####################################################
+
+
+def main():
+    args = parse_args()
+    regions = get_regions(args)
+
+    logger.info("Parsing VCF header")
+    header_lines = parse_vcf_header(args.vcf_file)
+    info_fields = list(parse_field_definitions(header_lines, "INFO"))
+    format_fields = list(parse_field_definitions(header_lines, "FORMAT"))
+    logger.info(f"INFO keys: {', '.join(info_fields)}")
+    logger.info(f"FORMAT fields: {', '.join(format_fields)}")
+
+    # raw columns are kept so that VCF records can be written back as they were
+    vcf_lf = parse_typed_vcf_data(
+        args.vcf_file,
+        format_fields,
+        keep_sample_columns=True,
+        info_fields=info_fields,
+        regions=regions,
+    )
+
+    prepare_outdir(args.vcf_file, args.outdir)
+    write_header(args.vcf_file, args.outdir)
+
+    logger.info(f"Writing VCF store to {args.outdir}")
+    # zero-padded file indexes so that parts are read back in the original order
+    vcf_lf.sink_parquet(
+        pl.PartitionMaxSize(
+            args.outdir,
+            file_path=lambda ctx: f"part-{ctx.file_idx:06d}.parquet",
+            max_size=args.max_rows_per_file,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -29,14 +29,14 @@ def parse_args():
         type=Path,
         dest="vcf_file",
         required=True,
-        help="Path to VCF file",
+        help="Path to VCF file (or VCF store)",
     )
     parser.add_argument(
         "--filtered-vcf",
         type=Path,
         dest="filtered_vcf_file",
         required=True,
-        help="Path to filtered VCF file",
+        help="Path to filtered VCF file (or VCF store)",
     )
     parser.add_argument(
         "--out",
@@ -6,7 +6,19 @@ from pathlib import Path
 
 import polars as pl
 
-from common import parse_vcf_data, get_position_in_format, parse_vcf_header
+from common import (
+    add_output_arguments,
+    add_region_arguments,
+    get_first_values,
+    get_genotypes,
+    get_regions,
+    parse_typed_vcf_data,
+    parse_vcf_columns,
+    parse_vcf_data,
+    parse_vcf_header,
+    write_vcf,
+)
+from genotype_model import GenotypeModel, sink_distance_scores
 
 pl.Config.set_streaming_chunk_size(int(1e6))
 
@@ -30,7 +42,7 @@ def parse_args():
         type=Path,
         dest="vcf_file",
         required=True,
-        help="Path to VCF file",
+        help="Path to VCF file (or VCF store)",
     )
     parser.add_argument(
         "--genotypes",
@@ -43,12 +55,21 @@ def parse_args():
         type=Path,
         dest="outfile",
         required=True,
-        help="Path to output file",
+        help="Path to output VCF file (bgzipped and indexed when ending in .gz)",
     )
     parser.add_argument(
         "--strict", 
         action="store_true"
     )
+    parser.add_argument(
+        "--distance-out",
+        type=Path,
+        dest="distance_outfile",
+        help="Path to output file of the distance to expected allele frequencies "
+        "of the SNPs kept (computed in the same pass over the VCF)",
+    )
+    add_region_arguments(parser)
+    add_output_arguments(parser)
     return parser.parse_args()
 
 
@@ -70,37 +91,46 @@ def add_windows(lf: pl.LazyFrame, window_size: int) -> pl.LazyFrame:
 
 def main():
     args = parse_args()
+    regions = get_regions(args)
 
     logger.info("Parsing VCF file")
-    vcf_lf = parse_vcf_data(args.vcf_file)
+    vcf_columns = parse_vcf_columns(args.vcf_file)
+    samples = vcf_columns[9:]
+    # genotypes are read from the raw sample columns, other FORMAT fields are decoded if needed
+    if args.distance_outfile:
+        vcf_lf = parse_typed_vcf_data(
+            args.vcf_file, ["VAF1"], keep_sample_columns=True, regions=regions
+        )
+    else:
+        vcf_lf = parse_vcf_data(args.vcf_file, regions)
 
     header = parse_vcf_header(args.vcf_file)
 
-    sample_genotypes_df = pl.read_csv(args.genotype_file)
-    sample_genotypes_df = sample_genotypes_df.with_columns(
-        genotypes=pl.col("genotypes").replace("het", "0/1:1/0").replace("hom", "0/0:1/1").str.split(":")
-    )
-    sample_to_genotypes = { d["sample"]: d["genotypes"] for d in sample_genotypes_df.to_dicts() }
-
-    if not args.strict:
-        sample_to_genotypes = {
-            k: lst + ["."] for k, lst in sample_to_genotypes.items()
-        }
-
-    GT_index = get_position_in_format(vcf_lf, "GT")
-    samples = vcf_lf.collect_schema().names()[9:]
+    genotype_model = GenotypeModel.from_file(args.genotype_file)
 
     logger.info("Filtering genotypes")
-    for sample in samples:
-        expected_genotypes = sample_to_genotypes[sample]
-        vcf_lf = vcf_lf.filter(
-            pl.col(sample).str.split(":").list[GT_index].is_in(expected_genotypes)
+    vcf_lf = genotype_model.filter_genotypes(vcf_lf, get_genotypes(samples), args.strict)
+
+    other_sinks = []
+    if args.distance_outfile:
+        # filtered variants are shared by both outputs, so that the VCF is parsed only once
+        vcf_lf = vcf_lf.cache()
+        allele_frequencies = get_first_values(vcf_lf.collect_schema(), samples, "VAF1")
+        logger.info(
+            f"Computing distance to expected allele frequency in {args.distance_outfile}"
+        )
+        other_sinks.append(
+            sink_distance_scores(
+                vcf_lf.select(genotype_model.get_distance_score(allele_frequencies)),
+                args.distance_outfile,
+                lazy=True,
+            )
         )
 
     logger.info(f"Writing filtered data to {args.outfile}")
-    with open(args.outfile, 'w') as fout:
-        fout.writelines(header)
-        vcf_lf.rename({"CHROM": "#CHROM"}).sink_csv(fout, separator="\t")
+    write_vcf(
+        vcf_lf.select(vcf_columns), header, args.outfile, args.index_format, other_sinks
+    )
 
 
 if __name__ == "__main__":
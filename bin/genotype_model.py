@@ -0,0 +1,179 @@
+import re
+from dataclasses import dataclass
+from functools import reduce
+from itertools import product
+from operator import or_
+from pathlib import Path
+
+import polars as pl
+
+# allele frequencies implied by the genotypes of a genotype design
+GENOTYPES_TO_ALLELE_FREQUENCIES = {
+    "0/0": 0,
+    "0/1": 0.5,
+    "1/0": 0.5,
+    "1/1": 1,
+}
+# shorthands of the genotype file
+GENOTYPE_SHORTHANDS = {
+    "het": "0/1:1/0",
+    "hom": "0/0:1/1",
+}
+# alleles of a genotype are separated by / (unphased) or | (phased)
+ALLELE_SEPARATOR_REGEX = re.compile(r"[/|]")
+# each distinct expected genotype is a bit of the masks of allowed genotypes,
+# the last bit standing for missing genotypes
+MISSING_GENOTYPE = "."
+MISSING_GENOTYPE_CODE = 1 << 63
+MAX_NB_GENOTYPE_CODES = 63
+# exponent applied to the mean distance of each SNP
+DISTANCE_SCORE_EXPONENT = 6
+# value written instead of distance scores equal to 0
+MIN_DISTANCE_SCORE = 1e-40
+
+
+@dataclass
+class GenotypeModel:
+    """
+    Genotypes expected for each sample (genotype design),
+    compiled into expressions evaluated for all samples at once
+    """
+
+    expected_genotypes: dict[str, list[str]]
+
+    @classmethod
+    def from_file(cls, genotype_file: Path) -> "GenotypeModel":
+        """
+        Parses a CSV file with columns sample and genotypes
+        (genotypes separated by ":", "het" standing for 0/1:1/0 and "hom" for 0/0:1/1)
+        """
+        genotypes_df = pl.read_csv(genotype_file).with_columns(
+            pl.col("genotypes").replace(GENOTYPE_SHORTHANDS).str.split(":")
+        )
+        return cls(dict(zip(genotypes_df["sample"], genotypes_df["genotypes"].to_list())))
+
+    def get_expected_genotypes(self, sample: str) -> list[str]:
+        if sample not in self.expected_genotypes:
+            raise ValueError(f"No expected genotypes for sample {sample}")
+        return self.expected_genotypes[sample]
+
+    def get_expected_frequencies(self, sample: str) -> list[float]:
+        # genotypes without allele frequency (missing genotypes ./. for instance) are skipped
+        frequencies = {
+            GENOTYPES_TO_ALLELE_FREQUENCIES[genotype]
+            for genotype in self.get_expected_genotypes(sample)
+            if genotype in GENOTYPES_TO_ALLELE_FREQUENCIES
+        }
+        if not frequencies:
+            raise ValueError(f"No expected allele frequency for sample {sample}")
+        return sorted(frequencies)
+
+    def get_genotype_codes(self) -> dict[str, int]:
+        """
+        Code (a single bit) of each expected genotype, under all its spellings:
+        phased genotypes match the unphased genotypes with the same alleles in the same order.
+        Genotypes that are not expected have no code.
+        """
+        genotypes = {
+            ALLELE_SEPARATOR_REGEX.sub("/", genotype)
+            for genotypes in self.expected_genotypes.values()
+            for genotype in genotypes
+        }
+        if len(genotypes) > MAX_NB_GENOTYPE_CODES:
+            raise ValueError(
+                f"At most {MAX_NB_GENOTYPE_CODES} distinct genotypes can be expected, "
+                f"got {len(genotypes)}"
+            )
+        codes = {MISSING_GENOTYPE: MISSING_GENOTYPE_CODE}
+        for bit, genotype in enumerate(sorted(genotypes)):
+            alleles = genotype.split("/")
+            for separators in product("/|", repeat=len(alleles) - 1):
+                spelling = alleles[0] + "".join(map("".join, zip(separators, alleles[1:])))
+                codes[spelling] = 1 << bit
+        return codes
+
+    def get_allowed_codes(self, sample: str, strict: bool = False) -> int:
+        """
+        Bitmask of the codes of the genotypes expected for the sample,
+        including missing genotypes unless strict
+        """
+        codes = self.get_genotype_codes()
+        allowed_codes = reduce(
+            or_,
+            (
+                codes[ALLELE_SEPARATOR_REGEX.sub("/", genotype)]
+                for genotype in self.get_expected_genotypes(sample)
+            ),
+            0,
+        )
+        if not strict:
+            allowed_codes |= MISSING_GENOTYPE_CODE
+        return allowed_codes
+
+    def filter_genotypes(
+        self, vcf_lf: pl.LazyFrame, genotypes: dict[str, pl.Expr], strict: bool = False
+    ) -> pl.LazyFrame:
+        """
+        Keeps SNPs whose genotypes (see common.get_genotypes) are all expected.
+        Each genotype is mapped once to its code, then checked against the bitmask
+        of the codes allowed for its sample, for all samples at once.
+        Unless strict, missing genotypes (".", or nulls when GT is absent) are accepted.
+        """
+        codes = self.get_genotype_codes()
+        code_cols = {sample: f"{sample}__genotype_code" for sample in genotypes}
+        return (
+            vcf_lf.with_columns(
+                genotype.fill_null(MISSING_GENOTYPE)
+                .replace_strict(codes, default=0, return_dtype=pl.UInt64)
+                .alias(code_cols[sample])
+                for sample, genotype in genotypes.items()
+            )
+            # codes are computed before filtering, so that the filter is only made of bitwise checks
+            .filter(
+                pl.all_horizontal(
+                    (
+                        pl.col(code_col)
+                        & pl.lit(self.get_allowed_codes(sample, strict), dtype=pl.UInt64)
+                    )
+                    != 0
+                    for sample, code_col in code_cols.items()
+                )
+            )
+            .drop(code_cols.values())
+        )
+
+    def get_distance_score(self, allele_frequencies: dict[str, pl.Expr]) -> pl.Expr:
+        """
+        Scores each SNP by (sqrt(sum of squared distances) / number of distances) ** 6,
+        the distance of each sample being the one between its allele frequency
+        and the closest expected frequency.
+        Scores of SNPs without any allele frequency are null.
+        """
+        distances = [
+            pl.min_horizontal(
+                (allele_frequency.cast(pl.Float64) - frequency) ** 2
+                for frequency in self.get_expected_frequencies(sample)
+            )
+            for sample, allele_frequency in allele_frequencies.items()
+        ]
+        nb_distances = pl.sum_horizontal(distance.is_not_null() for distance in distances)
+        # mean and not sum in order to compensate for missing values
+        sum_of_squares = pl.sum_horizontal(distances, ignore_nulls=True)
+        score = (sum_of_squares.sqrt() / nb_distances.cast(pl.Float32)) ** DISTANCE_SCORE_EXPONENT
+        return (
+            pl.when(nb_distances == 0)
+            .then(None)
+            .when(score == 0)
+            .then(MIN_DISTANCE_SCORE)
+            .otherwise(score)
+            .alias("score")
+        )
+
+
+def sink_distance_scores(scores_lf: pl.LazyFrame, outfile: Path, lazy: bool = False):
+    """
+    Writes one score per line (10 decimals), "nan" standing for missing scores
+    """
+    return scores_lf.sink_csv(
+        outfile, include_header=False, float_precision=10, null_value="nan", lazy=lazy
+    )
@@ -12,6 +12,7 @@ mkdir -p $OUTDIR
 
 prefix=$(basename $VCF .vcf.gz).snp_indel
 filtered_vcf=${OUTDIR}/${prefix}.genotype_filtered.vcf
+filtered_vcf_store=${OUTDIR}/${prefix}.genotype_filtered.vcf_store
 density_scores=${OUTDIR}/${prefix}.density_scores.txt
 
 if [ "$STRICT_MODE" = "true" ]; then
@@ -25,16 +26,24 @@ bin/filter_by_genotype.py \
     --out $filtered_vcf \
     $strict_flag
 
+# parsing the filtered VCF once for all downstream steps
+if [ -d $filtered_vcf_store ]; then
+    rm -rf $filtered_vcf_store
+fi
+bin/convert_vcf_to_parquet.py \
+    --vcf $filtered_vcf \
+    --out $filtered_vcf_store
+
 if [ -f $density_scores ]; then
     rm $density_scores
 fi
 bin/compute_snp_density.py \
-    --vcf $filtered_vcf \
+    --vcf $filtered_vcf_store \
     --out $density_scores \
     --window-size 20000
 
 bin/aggregate_data.py \
-    --vcf $filtered_vcf \
+    --vcf $filtered_vcf_store \
     --pvalues $density_scores \
     --design $DESIGN \
     --prefix ${OUTDIR}/$prefix \
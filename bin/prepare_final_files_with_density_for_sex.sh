@@ -17,6 +17,7 @@ filtered_vcf_2=${OUTDIR}/${prefix}.genotype_filtered.2.vcf
 sorted_vcf_1=${OUTDIR}/${prefix}.genotype_filtered.1.sorted.vcf.gz
 sorted_vcf_2=${OUTDIR}/${prefix}.genotype_filtered.2.sorted.vcf.gz
 filtered_vcf=${OUTDIR}/${prefix}.genotype_filtered.vcf
+filtered_vcf_store=${OUTDIR}/${prefix}.genotype_filtered.vcf_store
 density_scores=${OUTDIR}/${prefix}.density_scores.txt
 
 if [ "$STRICT_MODE" = "true" ]; then
@@ -46,16 +47,24 @@ micromamba run -n vcf \
     bcftools concat $sorted_vcf_1 $sorted_vcf_2 \
         -o $filtered_vcf -a
 
+# parsing the filtered VCF once for all downstream steps
+if [ -d $filtered_vcf_store ]; then
+    rm -rf $filtered_vcf_store
+fi
+bin/convert_vcf_to_parquet.py \
+    --vcf $filtered_vcf \
+    --out $filtered_vcf_store
+
 if [ -f $density_scores ]; then
     rm $density_scores
 fi
 bin/compute_snp_density.py \
-    --vcf $filtered_vcf \
+    --vcf $filtered_vcf_store \
     --out $density_scores \
     --window-size 20000
 
 bin/aggregate_data.py \
-    --vcf $filtered_vcf \
+    --vcf $filtered_vcf_store \
     --pvalues $density_scores \
     --design $DESIGN \
     --prefix ${OUTDIR}/$prefix \
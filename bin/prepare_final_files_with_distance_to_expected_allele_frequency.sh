@@ -12,6 +12,7 @@ mkdir -p $OUTDIR
 
 prefix=$(basename $VCF .vcf.gz).snp_indel
 filtered_vcf=${OUTDIR}/${prefix}.genotype_filtered.vcf
+filtered_vcf_store=${OUTDIR}/${prefix}.genotype_filtered.vcf_store
 scores=${OUTDIR}/${prefix}.distance_scores.txt
 
 if [ "$STRICT_MODE" = "true" ]; then
@@ -23,18 +24,19 @@ bin/filter_by_genotype.py \
     --vcf $VCF \
     --genotypes $GENOTYPES \
     --out $filtered_vcf \
+    --distance-out $scores \
     $strict_flag
 
-if [ -f $scores ]; then
-    rm $scores
+# parsing the filtered VCF once for all downstream steps
+if [ -d $filtered_vcf_store ]; then
+    rm -rf $filtered_vcf_store
 fi
-bin/compute_distance_to_expected_allele_frequency.py \
+bin/convert_vcf_to_parquet.py \
     --vcf $filtered_vcf \
-    --genotypes $GENOTYPES \
-    --out $scores
+    --out $filtered_vcf_store
 
 bin/aggregate_data.py \
-    --vcf $filtered_vcf \
+    --vcf $filtered_vcf_store \
     --pvalues $scores \
     --design $DESIGN \
     --prefix ${OUTDIR}/$prefix \
@@ -14,6 +14,8 @@ mkdir -p $OUTDIR
 prefix=$(basename $VCF .vcf.gz).snp_indel
 filtered_vcf_1=${OUTDIR}/${prefix}.genotype_filtered.1.vcf
 filtered_vcf_2=${OUTDIR}/${prefix}.genotype_filtered.2.vcf
+filtered_vcf_store_1=${OUTDIR}/${prefix}.genotype_filtered.1.vcf_store
+filtered_vcf_store_2=${OUTDIR}/${prefix}.genotype_filtered.2.vcf_store
 scores_1=${OUTDIR}/${prefix}.distance_scores.1.txt
 scores_2=${OUTDIR}/${prefix}.distance_scores.2.txt
 
@@ -26,29 +28,36 @@ bin/filter_by_genotype.py \
     --vcf $VCF \
     --genotypes $GENOTYPES_1 \
     --out $filtered_vcf_1 \
+    --distance-out $scores_1 \
     $strict_flag
 
 bin/filter_by_genotype.py \
     --vcf $VCF \
     --genotypes $GENOTYPES_2 \
     --out $filtered_vcf_2 \
+    --distance-out $scores_2 \
     $strict_flag
 
-bin/compute_distance_to_expected_allele_frequency.py \
+# parsing the filtered VCFs once for all downstream steps
+if [ -d $filtered_vcf_store_1 ]; then
+    rm -rf $filtered_vcf_store_1
+fi
+bin/convert_vcf_to_parquet.py \
     --vcf $filtered_vcf_1 \
-    --genotypes $GENOTYPES_1 \
-    --out $scores_1
+    --out $filtered_vcf_store_1
 
-bin/compute_distance_to_expected_allele_frequency.py \
+if [ -d $filtered_vcf_store_2 ]; then
+    rm -rf $filtered_vcf_store_2
+fi
+bin/convert_vcf_to_parquet.py \
     --vcf $filtered_vcf_2 \
-    --genotypes $GENOTYPES_2 \
-    --out $scores_2
+    --out $filtered_vcf_store_2
 
 bin/aggregate_data2.py \
-    --vcf1 $filtered_vcf_1 \
-    --vcf2 $filtered_vcf_2 \
-    --pvalues1 $scores_1 \
-    --pvalues2 $scores_2 \
+    --vcf $filtered_vcf_store_1 \
+    --pvalues $scores_1 \
+    --vcf $filtered_vcf_store_2 \
+    --pvalues $scores_2 \
     --design $DESIGN \
     --prefix ${OUTDIR}/$prefix \
     --window-size 20000
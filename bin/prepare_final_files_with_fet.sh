@@ -9,12 +9,21 @@ OUTDIR=$3
 mkdir -p $OUTDIR
 
 prefix=$(basename $VCF .vcf.gz).snp_indel
+vcf_store=${OUTDIR}/${prefix}.vcf_store
 RO_counts=${OUTDIR}/${prefix}.RO_counts.parquet
 AO_counts=${OUTDIR}/${prefix}.AO_counts.parquet
 pvalues=${OUTDIR}/${prefix}.pvalues.txt
 
+# parsing the VCF once for all downstream steps
+if [ -d $vcf_store ]; then
+    rm -rf $vcf_store
+fi
+bin/convert_vcf_to_parquet.py \
+    --vcf $VCF \
+    --out $vcf_store
+
 bin/separate_vcf_data.py \
-    --vcf $VCF
+    --vcf $vcf_store
 
 mv RO_counts.parquet $RO_counts
 mv AO_counts.parquet $AO_counts
@@ -30,7 +39,7 @@ micromamba run -n stat_test bin/compute_statistical_test.R \
     --out $pvalues
 
 bin/aggregate_data.py \
-    --vcf $VCF \
+    --vcf $vcf_store \
     --pvalues $pvalues \
     --design $DESIGN \
     --prefix ${OUTDIR}/$prefix \
@@ -5,7 +5,16 @@ import logging
 from pathlib import Path
 
 import polars as pl
-from common import parse_vcf_data
+from common import (
+    COUNT_LAYOUTS,
+    add_region_arguments,
+    extract_counts,
+    get_regions,
+    get_samples,
+    parse_typed_vcf_data,
+    parse_vcf_columns,
+    sink_counts,
+)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -16,6 +25,8 @@ VARIANTS_OUTFILE = "variants.parquet"
 
 VCF_COLUMNS_TO_KEEP = ["CHROM", "POS", "REF", "ALT", "QUAL", "INFO"]
 
+ROW_GROUP_SIZE = 100000
+
 #####################################################
 #####################################################
 # FUNCTIONS
@@ -30,25 +41,25 @@ def parse_args():
         type=Path,
         dest="vcf_file",
         required=True,
-        help="Path to VCF file",
+        help="Path to VCF file (or VCF store)",
     )
-    return parser.parse_args()
-
-
-def get_position_in_format(vcf_lf: pl.LazyFrame, info: str) -> int:
-    fmt_series = vcf_lf.select("FORMAT").collect().to_series()
-    if fmt_series.unique().len() > 1:
-        raise ValueError(f"More than one format found: {fmt_series.unique()}")
-    fmt = fmt_series.unique().item()
-    return fmt.split(":").index(info)
-
-
-def extract_counts(
-    vcf_lf: pl.LazyFrame, sample_cols: list[str], idx: int
-) -> pl.LazyFrame:
-    return vcf_lf.select(
-        pl.col(sample_cols).str.split(":").list[idx].replace(".", None).cast(pl.Int64)
+    parser.add_argument(
+        "--count-layout",
+        dest="count_layout",
+        choices=COUNT_LAYOUTS,
+        default="dense",
+        help="Layout of the count files: dense (as is), compact (unsigned 32-bit counts) "
+        "or sparse (variant index, sample index, count entries for non-zero counts)",
+    )
+    parser.add_argument(
+        "--row-group-size",
+        dest="row_group_size",
+        type=int,
+        default=ROW_GROUP_SIZE,
+        help="Number of variants per row group in output parquet files",
     )
+    add_region_arguments(parser)
+    return parser.parse_args()
 
 
 #####################################################
@@ -60,22 +71,43 @@ def extract_counts(
 
 def main():
     args = parse_args()
+    regions = get_regions(args)
 
     logger.info("Parsing VCF file")
-
-    vcf_lf = parse_vcf_data(args.vcf_file)
-
-    RO_index = get_position_in_format(vcf_lf, "RO")
-    AO_index = get_position_in_format(vcf_lf, "AO")
-
-    sample_cols = vcf_lf.collect_schema().names()[9:]
-    RO_lf = extract_counts(vcf_lf, sample_cols, RO_index)
-    AO_lf = extract_counts(vcf_lf, sample_cols, AO_index)
-
-    RO_lf.sink_parquet(RO_OUTFILE)
-    AO_lf.sink_parquet(AO_OUTFILE)
-
-    vcf_lf.sink_parquet(VARIANTS_OUTFILE)
+    vcf_columns = parse_vcf_columns(args.vcf_file)
+    sample_cols = get_samples(args.vcf_file)
+
+    # all outputs are computed from a single decode of the VCF, shared between the sinks
+    vcf_lf = parse_typed_vcf_data(
+        args.vcf_file, ["RO", "AO"], keep_sample_columns=True, regions=regions
+    ).cache()
+    RO_lf = extract_counts(vcf_lf, sample_cols, "RO")
+    AO_lf = extract_counts(vcf_lf, sample_cols, "AO")
+
+    logger.info("Writing variants and counts")
+    pl.collect_all(
+        [
+            sink_counts(
+                RO_lf,
+                sample_cols,
+                RO_OUTFILE,
+                args.count_layout,
+                row_group_size=args.row_group_size,
+                lazy=True,
+            ),
+            sink_counts(
+                AO_lf,
+                sample_cols,
+                AO_OUTFILE,
+                args.count_layout,
+                row_group_size=args.row_group_size,
+                lazy=True,
+            ),
+            vcf_lf.select(vcf_columns).sink_parquet(
+                VARIANTS_OUTFILE, row_group_size=args.row_group_size, lazy=True
+            ),
+        ]
+    )
 
 
 if __name__ == "__main__":
@@ -9,17 +9,18 @@ process ADDITIONAL_FILTERING {
         'community.wave.seqera.io/library/htslib_matplotlib_polars_python:b8381ca8e371940c' }"
 
     input:
-    tuple val(meta), path(vcf)
+    tuple val(meta), path(vcf), path(tbi)
     val(min_depth_quantile)
     val(max_depth_quantile)
 
     output:
-    tuple val(meta), path("${prefix}.vcf.gz"), optional: true,                                                                emit: vcf
+    tuple val(meta), path("${prefix}.vcf.gz"), path("${prefix}.vcf.gz.tbi"), optional: true,                                 emit: vcf_tbi
     tuple val("${task.process}"), val('python'),       eval("python3 --version | sed 's/Python //'"),                         topic: versions
     tuple val("${task.process}"), val('polars'),       eval('python3 -c "import polars; print(polars.__version__)"'),         topic: versions
     tuple val("${task.process}"), val('matplotlib'),   eval('python3 -c "import matplotlib; print(matplotlib.__version__)"'), topic: versions
 
     script:
+    def args = task.ext.args ?: ''
     prefix = task.ext.prefix ?: "${meta.id}.refiltered"
     """
     # limiting number of threads
@@ -29,13 +30,11 @@ process ADDITIONAL_FILTERING {
 
     apply_additional_filters.py \\
         --vcf $vcf \\
-        --out ${prefix}.vcf \\
+        --out ${prefix}.vcf.gz \\
+        --cpus ${task.cpus} \\
         --min-depth-quantile $min_depth_quantile \\
-        --max-depth-quantile $max_depth_quantile
-
-    if [[ -f ${prefix}.vcf ]]; then
-        bgzip ${prefix}.vcf
-    fi
+        --max-depth-quantile $max_depth_quantile \\
+        $args
     """
 
 }
@@ -11,6 +11,7 @@ process AGGREGATE_DATA {
     input:
     tuple val(meta), path(vcf), path(pvalue_file)
     val(window_size)
+    val(window_step)
 
     output:
     tuple val(meta), path("*.formated_variants.parquet"),                                                       emit: variants
@@ -20,6 +21,7 @@ process AGGREGATE_DATA {
     tuple val("${task.process}"), val('tqdm'),   eval('python3 -c "import tqdm; print(tqdm.__version__)"'),     topic: versions
 
     script:
+    def args = task.ext.args ?: ''
     def prefix = "${meta.id}.${meta.type}"
     """
     # limiting number of threads
@@ -29,7 +31,9 @@ process AGGREGATE_DATA {
         --vcf $vcf \\
         --pvalues $pvalue_file \\
         --prefix ${prefix} \\
-        --window-size $window_size
+        --window-size $window_size \\
+        --window-step $window_step \\
+        $args
     """
 
 }
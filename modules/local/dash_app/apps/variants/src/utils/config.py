@@ -11,6 +11,8 @@ DATA_FOLDER = "data"
 
 VARIANT_TYPES = ["snp_indel", "sv"]
 INPUT_FILE_SUFFIX = "formated_variants.parquet"
+# samples of the allele_counts struct column, by phenotype (written by aggregate_data.py)
+ALLELE_COUNTS_METADATA_KEY = "allele_counts_phenotypes"
 
 
 AG_GRID_DEFAULT_COLUMN_DEF = {
@@ -1,3 +1,4 @@
+import json
 import logging
 from functools import lru_cache
 from pathlib import Path
@@ -19,7 +20,9 @@ class DataManager:
         folder = Path(config.DATA_FOLDER)
         # compute other static values
         self.variants = {}
+        self.allele_count_phenotypes = {}
         self.quantiles = {}
+        self.chromosome_ranges = {}
         self.parsed_variant_types = []
         for variant_type in config.VARIANT_TYPES:
             logger.info(f"Preparing {variant_type} data")
@@ -33,7 +36,13 @@ class DataManager:
                 continue
 
             self.variants[variant_type] = self.prepare_data(variant_file)
+            self.allele_count_phenotypes[variant_type] = self.parse_allele_count_phenotypes(
+                variant_file
+            )
             self.quantiles[variant_type] = self.get_quantiles(variant_type)
+            self.chromosome_ranges[variant_type] = self.get_chromosome_ranges(
+                self.variants[variant_type]
+            )
             self.parsed_variant_types.append(variant_type)
 
             logger.info(f"{variant_type} data loaded")
@@ -67,14 +76,48 @@ class DataManager:
             .item(0)
         )
 
+    @staticmethod
+    def get_chromosome_ranges(lf: pl.LazyFrame | None) -> pl.DataFrame | None:
+        """
+        Row ranges (offset, length) of the runs of consecutive variants on the same chromosome,
+        with their maximum position, found in a single scan
+        """
+        if lf is None:
+            return None
+        return (
+            lf.select("chromosome", "position")
+            .with_row_index("offset")
+            .group_by(pl.col("chromosome").rle_id().alias("run"), maintain_order=True)
+            .agg(
+                pl.col("chromosome").first(),
+                pl.col("offset").first(),
+                pl.len().alias("length"),
+                pl.col("position").max().alias("max_pos"),
+            )
+            .drop("run")
+            .collect()
+        )
+
+    def get_chromosome_variants(self, variant_type: str, chromosome: str) -> pl.LazyFrame:
+        # variants of a chromosome held in a single range are read as a slice of the file
+        ranges_df = self.chromosome_ranges[variant_type].filter(
+            pl.col("chromosome") == chromosome
+        )
+        if len(ranges_df) == 1:
+            return self.variants[variant_type].slice(
+                ranges_df["offset"].item(), ranges_df["length"].item()
+            )
+        return self.variants[variant_type].filter(pl.col("chromosome") == chromosome)
+
     def get_sorted_chromosomes(self, variant_type: str) -> pl.LazyFrame:
         if self.variants[variant_type] is None:
             return pl.LazyFrame(schema=["chromosome"])
 
         return (
-            self.variants[variant_type]
+            self.chromosome_ranges[variant_type]
+            .lazy()
             .group_by("chromosome")
-            .agg(pl.col("position").max().alias("max_pos"))
+            .agg(pl.col("max_pos").max())
             .sort("max_pos", descending=True)
         )
 
@@ -114,6 +157,30 @@ class DataManager:
             ),
         )
 
+    @staticmethod
+    def parse_allele_count_phenotypes(file: Path) -> dict[str, list[str]] | None:
+        # older files hold allele counts as preformatted strings, without metadata
+        metadata = pl.read_parquet_metadata(file)
+        if config.ALLELE_COUNTS_METADATA_KEY not in metadata:
+            return None
+        return json.loads(metadata[config.ALLELE_COUNTS_METADATA_KEY])
+
+    @staticmethod
+    def format_allele_counts(phenotype_to_samples: dict[str, list[str]]) -> pl.Expr:
+        allele_counts = pl.col("allele_counts")
+        parts = [pl.lit("Counts (REF / ALT / ...):<br>")]
+        for phenotype, samples in phenotype_to_samples.items():
+            parts.append(pl.lit(f"  Phenotype: {phenotype}:<br>"))
+            for sample in samples:
+                counts = (
+                    allele_counts.struct.field(sample)
+                    .cast(pl.List(pl.String))
+                    .list.join(" / ")
+                    .fill_null("")
+                )
+                parts += [pl.lit(f"    {sample}: "), counts, pl.lit("<br>")]
+        return pl.concat_str(parts).alias("allele_counts")
+
     def get_quantiles(self, variant_type: str) -> dict[float, float]:
         if self.variants[variant_type] is None:
             return {}
@@ -150,9 +217,8 @@ class DataManager:
         min_pvalue = self.quantiles[variant_type][pvalue_quantile_range[0]]
         max_pvalue = self.quantiles[variant_type][pvalue_quantile_range[1]]
 
-        return (
-            self.variants[variant_type]
-            .filter(pl.col("chromosome") == chromosome)
+        lf = (
+            self.get_chromosome_variants(variant_type, chromosome)
             .filter(pl.col("pvalue").is_between(min_pvalue, max_pvalue))
             .filter(
                 pl.col("quality").is_between(quality_range[0], quality_range[1] + 1)
@@ -160,6 +226,9 @@ class DataManager:
             .filter(
                 pl.col("total_depth").is_between(depth_range[0], depth_range[1] + 1)
             )
-            .collect()
-            .to_pandas()
         )
+        # hover texts are only rendered for the variants sent to the graph
+        phenotype_to_samples = self.allele_count_phenotypes[variant_type]
+        if phenotype_to_samples is not None:
+            lf = lf.with_columns(self.format_allele_counts(phenotype_to_samples))
+        return lf.collect().to_pandas()
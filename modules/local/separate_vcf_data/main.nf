@@ -19,13 +19,15 @@ process SEPARATE_VCF_DATA {
     tuple val("${task.process}"), val('polars'), eval('python3 -c "import polars; print(polars.__version__)"'), topic: versions
 
     script:
+    def args = task.ext.args ?: ''
     prefix = "${meta.id}"
     """
     # limiting number of threads
     export POLARS_MAX_THREADS=${task.cpus}
 
     separate_vcf_data.py \\
-        --vcf $vcf
+        --vcf $vcf \\
+        $args
 
     mv variants.parquet ${prefix}.variants.parquet
     mv RO_counts.parquet ${prefix}.RO_counts.parquet
@@ -12,21 +12,33 @@ process STATISTICAL_TEST {
     tuple val(meta), path(reference_count_file), path(alternative_count_file)
     path design
     val statistical_test
+    val engine
 
     output:
-    tuple val(meta), path("*.cmh_pvalues.txt"),                                                                    emit: pvalues
+    tuple val(meta), path("*.pvalues.parquet"),                                                                    emit: pvalues
     tuple val("${task.process}"), val('R'),     eval('Rscript -e "cat(R.version.string)" | sed "s/R version //"'), topic: versions
     tuple val("${task.process}"), val('dplyr'), eval('Rscript -e "cat(as.character(packageVersion(\'dplyr\')))"'), topic: versions
+    tuple val("${task.process}"), val('python'), eval("python3 --version | sed 's/Python //'"),                     topic: versions
+    tuple val("${task.process}"), val('scipy'),  eval('python3 -c "import scipy; print(scipy.__version__)"'),       topic: versions
 
     script:
+    def args = task.ext.args ?: ''
     prefix   = task.ext.prefix ?: "${meta.id}"
+    def script_name = engine == 'python' ? 'compute_fischer_exact_test.py' : 'compute_statistical_test.R'
+    // the python engine tests chunks of variants in parallel
+    def engine_args = engine == 'python' ? "--cpus ${task.cpus}" : ''
     """
-    compute_statistical_test.R \\
+    # limiting number of threads
+    export POLARS_MAX_THREADS=${task.cpus}
+
+    ${script_name} \\
         --method $statistical_test \\
         --RO $reference_count_file \\
         --AO $alternative_count_file \\
         --design $design \\
-        --out ${prefix}.cmh_pvalues.txt
+        --out ${prefix}.pvalues.parquet \\
+        $engine_args \\
+        $args
     """
 
 }
@@ -2,11 +2,16 @@
 
 import argparse
 import logging
+import sys
 from multiprocessing import Value
 from pathlib import Path
 
 import polars as pl
 
+# VCF helpers are shared with the pipeline scripts
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "bin"))
+from common import decode_format_fields, read_counts  # noqa: E402
+
 pl.Config.set_streaming_chunk_size(1e6)
 
 logging.basicConfig(level=logging.INFO)
@@ -99,23 +104,19 @@ def get_length(lf: pl.LazyFrame) -> int:
     return lf.select(pl.len()).collect().item(0, 0)
 
 
-def get_position_in_format(vcf_lf: pl.LazyFrame, info: str) -> int:
-    fmt_series = vcf_lf["FORMAT"]
-    if fmt_series.unique().len() > 1:
-        raise ValueError(f"More than one format found: {fmt_series.unique()}")
-    fmt = fmt_series.unique().item()
-    return fmt.split(":").index(info)
-
-
-def extract_vaf(vcf_lf: pl.LazyFrame, sample_cols: list[str], idx: int) -> pl.LazyFrame:
-    return vcf_lf.select(
-        pl.col("POS"),
-        pl.col(sample_cols)
-        .str.split(":")
-        .list[idx]
-        .replace(".", None)
-        .cast(pl.Float64),
-        # .cast(pl.Float64),
+def extract_vaf(df: pl.DataFrame, sample_cols: list[str]) -> pl.DataFrame:
+    # VAF is looked up in the FORMAT layout of each row
+    layouts = tuple(df["FORMAT"].unique(maintain_order=True).drop_nulls())
+    return (
+        decode_format_fields(
+            df.lazy().select("POS", "FORMAT", *sample_cols),
+            sample_cols,
+            ["VAF"],
+            {"VAF": {"number": "1", "type": "Float"}},
+            layouts,
+        )
+        .select("POS", *[pl.col(f"{sample}_VAF").alias(sample) for sample in sample_cols])
+        .collect()
     )
 
 
@@ -140,8 +141,8 @@ def main():
     populations = design_df["population"].unique().to_list()
 
     logger.info("Parsing allele counts")
-    RO_lf = pl.scan_parquet(args.RO_file).select(pl.all().name.suffix("_RO"))
-    AO_lf = pl.scan_parquet(args.AO_file).select(pl.all().name.suffix("_AO"))
+    RO_lf = read_counts(args.RO_file).lazy().select(pl.all().name.suffix("_RO"))
+    AO_lf = read_counts(args.AO_file).lazy().select(pl.all().name.suffix("_AO"))
 
     nb_variants = get_length(variant_lf)
     nb_pvalues = get_length(pvalues_lf)
@@ -165,10 +166,8 @@ def main():
     logger.info("Computing total depth")
     df = add_total_depth(df)
 
-    VAF_index = get_position_in_format(df, "VAF")
-
     sample_cols = df.collect_schema().names()[9:15]
-    vaf_lf = extract_vaf(df, sample_cols, VAF_index)
+    vaf_lf = extract_vaf(df, sample_cols)
 
     valid_positions = (
         vaf_lf.filter(
@@ -1,7 +1,6 @@
 include { BCFTOOLS_FILL_TAGS                             } from '../../../modules/local/bcftools/fill_tags'
 include { BCFTOOLS_VIEW as BASE_FILTERING                } from '../../../modules/local/bcftools/view'
 include { ADDITIONAL_FILTERING                           } from '../../../modules/local/additional_filtering'
-include { BCFTOOLS_INDEX                                 } from '../../../modules/local/bcftools/index'
 
 
 
@@ -49,19 +48,13 @@ workflow FILTER_VARIANTS {
     // -----------------------------------------------------------------
 
     ADDITIONAL_FILTERING (
-        BASE_FILTERING.out.vcf_tbi.map { meta, vcf, tbi -> [ meta, vcf ] },
+        BASE_FILTERING.out.vcf_tbi,
         min_depth_quantile,
         max_depth_quantile
     )
-    ch_filtered_vcf = ADDITIONAL_FILTERING.out.vcf
-
-    // -----------------------------------------------------------------
-    // INDEXING
-    // -----------------------------------------------------------------
-
-    BCFTOOLS_INDEX ( ch_filtered_vcf )
+    // filtered VCF files are bgzipped and indexed while they are written
 
     emit:
-    vcf_tbi = ch_filtered_vcf.join( BCFTOOLS_INDEX.out.tbi )
+    vcf_tbi = ADDITIONAL_FILTERING.out.vcf_tbi
 
 }
@@ -1,3 +1,4 @@
+include { CONVERT_VCF_TO_PARQUET                        } from '../../../modules/local/convert_vcf_to_parquet'
 include { SEPARATE_VCF_DATA                             } from '../../../modules/local/separate_vcf_data'
 include { STATISTICAL_TEST                              } from '../../../modules/local/statistical_test'
 include { AGGREGATE_DATA                                } from '../../../modules/local/aggregate_data'
@@ -10,15 +11,24 @@ workflow VARIANT_ANALYSIS {
     ch_vcf
     ch_design_file
     statistical_test
+    statistical_test_engine
     window_size
+    window_step
 
     main:
 
+    // -----------------------------------------------------------------
+    // CONVERT VCF TO A PARQUET STORE, PARSED ONCE AND READ BY ALL DOWNSTREAM STEPS
+    // -----------------------------------------------------------------
+
+    CONVERT_VCF_TO_PARQUET ( ch_vcf )
+    ch_vcf_store = CONVERT_VCF_TO_PARQUET.out.store
+
     // -----------------------------------------------------------------
     // EXTRACT VARIANT DESCRIPTORS (LIKE REF AND ALT COUNTS) AND SEPARATE THEM FROM BASIC VARIANT FEATURESs
     // -----------------------------------------------------------------
 
-    SEPARATE_VCF_DATA ( ch_vcf )
+    SEPARATE_VCF_DATA ( ch_vcf_store )
 
     ch_variants   = SEPARATE_VCF_DATA.out.variants
     ch_ref_counts = SEPARATE_VCF_DATA.out.ref_counts
@@ -31,7 +41,8 @@ workflow VARIANT_ANALYSIS {
     STATISTICAL_TEST(
         ch_ref_counts.join( ch_alt_counts ),
         ch_design_file.collect(),
-        statistical_test
+        statistical_test,
+        statistical_test_engine
     )
 
     // -----------------------------------------------------------------
@@ -39,9 +50,9 @@ workflow VARIANT_ANALYSIS {
     // -----------------------------------------------------------------
 
     AGGREGATE_DATA(
-        ch_vcf.join( STATISTICAL_TEST.out.pvalues ),
-        window_size
-
+        ch_vcf_store.join( STATISTICAL_TEST.out.pvalues ),
+        window_size,
+        window_step
     )
 
     emit:
@@ -0,0 +1,132 @@
+"""
+Regression test of the bgzipped VCF writer: parts written by write_vcf_part,
+merged by merge_vcf_parts and indexed on the fly must be readable by htslib (pysam),
+each region query returning the same records as a direct filter of the variants.
+
+Run with: python -m pytest tests/python
+"""
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "bin"))
+
+from common import merge_vcf_parts, write_vcf, write_vcf_part  # noqa: E402
+
+pysam = pytest.importorskip("pysam")
+
+CONTIG_LENGTHS = {"chr1": 2_000_000, "scaffold_2": 150_000, "chr3": 30_000_000}
+# contigs longer than 2^29 bp only fit in csi indexes
+CSI_CONTIG_LENGTHS = CONTIG_LENGTHS | {"chr4": 600_000_000}
+COLUMNS = ["CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT", "sample"]
+REGIONS = [
+    ("chr1", 0, 1),
+    ("chr1", 16_000, 16_500),
+    ("chr1", 100_000, 1_500_000),
+    ("scaffold_2", 99_000, 100_000),
+    ("chr3", 0, 30_000_000),
+    ("chr3", 12_345_678, 12_400_000),
+    ("chr4", 536_870_000, 536_880_000),
+    ("chr4", 0, 600_000_000),
+]
+
+
+def get_contig_lengths(index_format: str) -> dict[str, int]:
+    return CSI_CONTIG_LENGTHS if index_format == "csi" else CONTIG_LENGTHS
+
+
+def get_header_lines(contig_lengths: dict[str, int]) -> list[str]:
+    return ["##fileformat=VCFv4.2\n"] + [
+        f"##contig=<ID={contig},length={length}>\n" for contig, length in contig_lengths.items()
+    ]
+
+
+def get_variants(contig_lengths: dict[str, int]) -> pl.DataFrame:
+    rng = np.random.default_rng(0)
+    contig_dfs = []
+    for contig, length in contig_lengths.items():
+        positions = np.unique(rng.integers(1, length - 50_000, 3_000))
+        # long deletions spanning several bins
+        ref_lengths = np.where(rng.random(len(positions)) < 0.05, 40_000, 1)
+        contig_dfs.append(
+            pl.DataFrame(
+                {
+                    "CHROM": contig,
+                    "POS": positions,
+                    "ID": ".",
+                    "REF": ["A" * n for n in ref_lengths],
+                    "ALT": "T",
+                    "QUAL": "50",
+                    "FILTER": "PASS",
+                    "INFO": ".",
+                    "FORMAT": "GT:DP",
+                    "sample": "0/1:10",
+                }
+            )
+        )
+    return pl.concat(contig_dfs).select(COLUMNS)
+
+
+def get_expected_records(variants_df: pl.DataFrame, contig: str, start: int, end: int) -> list:
+    record_end = pl.col("POS") - 1 + pl.col("REF").str.len_bytes()
+    return (
+        variants_df.filter(pl.col("CHROM") == contig, pl.col("POS") - 1 < end, record_end > start)
+        .select("POS", "REF")
+        .rows()
+    )
+
+
+def check_queries(vcf_file: Path, index_format: str, variants_df: pl.DataFrame):
+    contig_lengths = get_contig_lengths(index_format)
+    index_file = Path(f"{vcf_file}.{index_format}")
+    assert index_file.exists()
+    with pysam.TabixFile(str(vcf_file), index=str(index_file)) as tabix_file:
+        assert list(tabix_file.contigs) == list(contig_lengths)
+        for contig, start, end in REGIONS:
+            if contig not in contig_lengths:
+                continue
+            records = [line.split("\t") for line in tabix_file.fetch(contig, start, end)]
+            assert [(int(fields[1]), fields[3]) for fields in records] == get_expected_records(
+                variants_df, contig, start, end
+            ), f"{contig}:{start}-{end}"
+    with pysam.VariantFile(str(vcf_file)) as vcf:
+        assert sum(1 for _ in vcf) == variants_df.height
+
+
+@pytest.mark.parametrize("index_format", ["tbi", "csi"])
+def test_write_vcf(tmp_path: Path, index_format: str):
+    contig_lengths = get_contig_lengths(index_format)
+    variants_df = get_variants(contig_lengths)
+    outfile = tmp_path / "variants.vcf.gz"
+    nb_variants = write_vcf(
+        variants_df.lazy(), get_header_lines(contig_lengths), outfile, index_format
+    )
+    assert nb_variants == variants_df.height
+    check_queries(outfile, index_format, variants_df)
+
+
+@pytest.mark.parametrize("index_format", ["tbi", "csi"])
+def test_merge_vcf_parts(tmp_path: Path, index_format: str):
+    contig_lengths = get_contig_lengths(index_format)
+    header_lines = get_header_lines(contig_lengths)
+    variants_df = get_variants(contig_lengths)
+    # each contig is held in a single part (see append_index), parts holding one or several
+    # contigs, one of them being empty
+    contig_groups = [["chr1", "scaffold_2"], [], list(contig_lengths)[2:]]
+    part_files, part_indexes = [], []
+    for i, contigs in enumerate(contig_groups):
+        part_df = variants_df.filter(pl.col("CHROM").is_in(contigs))
+        part_file = tmp_path / f"part_{i}.vcf.gz"
+        nb_variants, part_index = write_vcf_part(
+            part_df.lazy(), header_lines, part_file, index_format
+        )
+        assert nb_variants == part_df.height
+        part_files.append(part_file)
+        part_indexes.append(part_index)
+    outfile = tmp_path / "merged.vcf.gz"
+    merge_vcf_parts(COLUMNS, header_lines, part_files, part_indexes, outfile, index_format)
+    check_queries(outfile, index_format, variants_df)
@@ -114,7 +114,10 @@ workflow VARIANT_CALLING {
             ch_filtered_vcf_tbi.map{ meta, vcf, tbi -> [ meta, vcf ] },
             ch_design_file,
             params.statistical_test,
-            params.window_size
+            params.statistical_test_engine,
+            params.window_size,
+            // non-overlapping windows by default
+            params.window_step ?: params.window_size
         )
 
         ch_variants                   = VARIANT_ANALYSIS.out.variants